@@ -0,0 +1,171 @@
+import csv, datetime, gzip, io, itertools, time
+
+from database import get_sync_state, advance_sync_state, find_known_order_ids
+from normalizers import normalize_amazon_order, to_cents, from_cents
+from rate_limiter import get_limiter
+from writers import BatchWriter, DEFAULT_BATCH_SIZE
+
+# Amazon docs: https://github.com/amzn/selling-partner-api-docs/blob/main/references/reports-api/reports_2021-06-30.md
+# Report types: https://github.com/amzn/selling-partner-api-docs/blob/main/references/reports-api/reporttype-values.md#order-reports
+REPORTS_PATH = '/reports/2021-06-30'
+ORDERS_REPORT_TYPE = 'GET_FLAT_FILE_ALL_ORDERS_DATA_BY_ORDER_DATE_GENERAL'
+
+
+class AmazonReportsBackfill:
+    # Backfill of the Amazon history from the order reports: one report per window of days instead of
+    # a getOrderItems call per order. The report rows are converted to the Orders API shape,
+    # so the totals are calculated by the same normalize_amazon_order
+    def __init__(self, connector):
+        self.connector = connector
+        self.platformConfig = connector.platformConfig
+        self.engine = connector.engine
+        self.reportsUrl = connector.apiUrl + REPORTS_PATH
+
+    def create_report(self, startTime, endTime):
+        response = self.connector.request(f'{self.reportsUrl}/reports', {}, get_limiter('createReport', self.connector.account), 'POST', {
+            'reportType': ORDERS_REPORT_TYPE,
+            'marketplaceIds': self.platformConfig['marketplace ids'],
+            'dataStartTime': startTime.isoformat() + 'Z',
+            'dataEndTime': endTime.isoformat() + 'Z',
+        })
+        return response.json()['reportId']
+
+    def wait_for_report(self, reportId):
+        # Returns the document ID when the report is done, or None if Amazon cancelled it (no data for the period)
+        while True:
+            response = self.connector.request(f'{self.reportsUrl}/reports/{reportId}', {}, get_limiter('getReport', self.connector.account))
+            status = response.json()['processingStatus']
+            if status == 'DONE':
+                return response.json()['reportDocumentId']
+            if status == 'CANCELLED':
+                return None
+            if status == 'FATAL':
+                raise Exception(f'Amazon report {reportId} failed: {response.json()}')
+            time.sleep(self.platformConfig.get('report poll seconds', 30))
+
+    def read_document(self, documentId):
+        # The document is downloaded from a pre-signed URL and decompressed while it is read
+        response = self.connector.request(f'{self.reportsUrl}/documents/{documentId}', {}, get_limiter('getReportDocument', self.connector.account))
+        document = response.json()
+        download = self.connector.session.get(document['url'], stream=True)
+        download.raise_for_status()
+        stream = download.raw
+        if document.get('compressionAlgorithm') == 'GZIP':
+            stream = gzip.GzipFile(fileobj=stream)
+        text = io.TextIOWrapper(stream, encoding=self.platformConfig.get('report encoding', 'utf-8'), errors='replace')
+        yield from csv.DictReader(text, delimiter='\t')
+
+    def group_orders(self, rows):
+        # The report has a row per line item, collect them into Orders API orders and order items.
+        # The rows are in order of the purchase date with the rows of an order one after another, so an order
+        # is complete at the first row of the next one and only that order is kept while the report is read
+        order = None
+        for row in rows:
+            orderId = row['amazon-order-id']
+            if order is None or order[0]['AmazonOrderId'] != orderId:
+                if order is not None:
+                    yield order
+                # Report dates have the time zone offset, convert them to the UTC format of the Orders API
+                purchaseDate = datetime.datetime.fromisoformat(row['purchase-date']).astimezone(datetime.timezone.utc)
+                lastUpdateDate = datetime.datetime.fromisoformat(row['last-updated-date']).astimezone(datetime.timezone.utc)
+                order = ({
+                    'AmazonOrderId': orderId,
+                    'PurchaseDate': purchaseDate.replace(tzinfo=None).isoformat() + 'Z',
+                    'LastUpdateDate': lastUpdateDate.replace(tzinfo=None).isoformat() + 'Z',
+                    'OrderStatus': row.get('order-status'),
+                    'FulfillmentInstruction': {'Name': ''},  # the reports don't have it
+                }, [])
+            order[1].append({
+                # Without the order-item-id column (not in the all orders report) the SKU, or the ASIN, identifies
+                # the line within the order; the rows of the same SKU are merged by merge_line_items
+                'OrderItemId': row.get('order-item-id') or row.get('sku') or row['asin'],
+                'SellerSKU': row.get('sku', ''),
+                'Title': row['product-name'],
+                'QuantityOrdered': int(row['quantity'] or 0),
+                # Same meaning as the Orders API fields; the report shows the discounts as negative numbers
+                'ItemPrice': {'Amount': row['item-price'] or '0'},
+                'ItemTax': {'Amount': row['item-tax'] or '0'},
+                'ShippingPrice': {'Amount': row['shipping-price'] or '0'},
+                'ShippingTax': {'Amount': row['shipping-tax'] or '0'},
+                'PromotionDiscount': {'Amount': (row['item-promotion-discount'] or '0').lstrip('-')},
+                'ShippingDiscount': {'Amount': (row['ship-promotion-discount'] or '0').lstrip('-')},
+            })
+        if order is not None:
+            yield order
+
+    def write_orders(self, orders, writer, syncState):
+        # Writes the orders of the report in chunks of batch size, checking which are known chunk by chunk.
+        # Returns the IDs of the written orders
+        writtenOrderIds = set()
+        orders = iter(orders)
+        while True:
+            chunk = list(itertools.islice(orders, writer.batchSize))
+            if not chunk:
+                return writtenOrderIds
+            knownOrderIds = find_known_order_ids(self.engine, 'amazon', [order['AmazonOrderId'] for order, _ in chunk],
+                                                 self.connector.account)
+            for order, lineItems in chunk:
+                if order['AmazonOrderId'] in writtenOrderIds:
+                    # Its first rows are written already, the upsert would replace them with these
+                    print(f'The report rows of the Amazon order {order["AmazonOrderId"]} are not together, '
+                          f'only its first rows are saved')
+                    continue
+                if order['AmazonOrderId'] in knownOrderIds:
+                    continue
+                orderRow, lineItemRows = normalize_amazon_order(
+                    dict(order, OrderTotal={'Amount': '0'}), lineItems)
+                lineItemRows = merge_line_items(lineItemRows)
+                # The report has no order total, it is the sum of the line items
+                orderRow['total_amount'] = from_cents(sum(to_cents(row['total_amount']) for row in lineItemRows))
+                # The known orders are skipped, so these have no saved line items to replace
+                writer.add(orderRow, lineItemRows, False)
+                writtenOrderIds.add(order['AmazonOrderId'])
+                advance_sync_state(syncState, *self.connector.order_checkpoint(order))
+
+    def run(self, since, until):
+        # Orders already saved by the regular sync are kept as they are
+        since, until = naive_utc(since), naive_utc(until)
+        syncState = get_sync_state(self.engine, self.connector.key)
+        writer = BatchWriter(self.engine, 'amazon', self.connector.config.get('batch size', DEFAULT_BATCH_SIZE),
+                             self.connector.config.get('bulk load threshold'), self.connector.account)
+        windowDays = self.platformConfig.get('report window days', 30)
+
+        try:
+            windowStart = since
+            while windowStart < until:
+                windowEnd = min(windowStart + datetime.timedelta(days=windowDays), until)
+                reportId = self.create_report(windowStart, windowEnd)
+                documentId = self.wait_for_report(reportId)
+                if documentId:
+                    # The orders are written while the report is downloaded and read
+                    self.write_orders(self.group_orders(self.read_document(documentId)), writer, syncState)
+                    writer.flush()
+                print(f'{self.connector.name} orders from {windowStart.date()} to {windowEnd.date()} backfilled')
+                windowStart = windowEnd
+
+            # The regular sync continues after the newest backfilled order
+            return writer.finish(syncState)
+        finally:
+            # The spool files of a failed backfill are removed too
+            writer.close()
+
+
+def merge_line_items(lineItemRows):
+    # The rows of an order with the same line ID (the same SKU in a report without order item IDs) become one
+    # line item with the summed quantity and total, as the upsert would keep only the last of them
+    merged = {}
+    for row in lineItemRows:
+        if row['line_id'] in merged:
+            line = merged[row['line_id']]
+            line['quantity'] += row['quantity']
+            line['total_amount'] = from_cents(to_cents(line['total_amount']) + to_cents(row['total_amount']))
+        else:
+            merged[row['line_id']] = dict(row)
+    return list(merged.values())
+
+
+def naive_utc(value):
+    # Dates with a time zone offset (e.g. from the command line) in UTC without the offset, as the report dates
+    if value.tzinfo is not None:
+        return value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return value
@@ -0,0 +1,130 @@
+import datetime, gzip, json, os, sqlite3, threading
+
+from writers import BatchWriter, DEFAULT_BATCH_SIZE
+
+application_path = os.path.abspath(os.path.dirname(__file__))
+
+
+class RawArchive:
+    # Append-only archive of the raw orders as returned by the APIs, so the normalization can be changed
+    # and the orders written again without calling the APIs (see replay).
+    # Layout: <folder>/<account key>/<UTC date>/<run start>.jsonl.gz, one JSON record per line: the raw order and
+    # its details (the Amazon order items). Every page is a separate gzip member appended to the segment,
+    # so a crash loses at most the page being written and a record can be read by seeking to its member.
+    # index.sqlite maps (account key, order ID) to the segment, member offset and line of the latest record
+    def __init__(self, folder):
+        self.folder = folder
+        self.runStart = datetime.datetime.utcnow().strftime('%H%M%S')
+        self.lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        self.index = sqlite3.connect(os.path.join(folder, 'index.sqlite'), check_same_thread=False)
+        self.index.execute(
+            """CREATE TABLE IF NOT EXISTS orders
+            (
+            platform TEXT NOT NULL,
+            order_id TEXT NOT NULL,
+            segment TEXT NOT NULL,
+            offset INTEGER NOT NULL,
+            line INTEGER NOT NULL,
+            PRIMARY KEY (platform, order_id)
+            );"""
+        )
+        self.index.commit()
+
+    def append(self, platform, orderIds, orders, details):
+        # One page of orders: orderIds, the raw orders and their details in the same order
+        if not orders:
+            return
+        fetched = datetime.datetime.utcnow()
+        segment = os.path.join(platform, fetched.strftime('%Y-%m-%d'), f'{self.runStart}.jsonl.gz')
+        lines = [json.dumps({'fetched': fetched.isoformat(), 'order': order, 'details': orderDetails}) + '\n'
+                 for order, orderDetails in zip(orders, details)]
+        member = gzip.compress(''.join(lines).encode('utf-8'))
+
+        with self.lock:
+            path = os.path.join(self.folder, segment)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'ab') as file:
+                offset = file.tell()
+                file.write(member)
+            self.index.executemany(
+                "INSERT OR REPLACE INTO orders (platform, order_id, segment, offset, line) VALUES (?, ?, ?, ?, ?);",
+                [(platform, str(orderId), segment, offset, line) for line, orderId in enumerate(orderIds)])
+            self.index.commit()
+
+    def find(self, platform, orderId):
+        # The latest archived record of the order, or None
+        with self.lock:
+            row = self.index.execute("SELECT segment, offset, line FROM orders WHERE platform=? AND order_id=?;",
+                                     (platform, str(orderId))).fetchone()
+        if row is None:
+            return None
+        segment, offset, line = row
+        with open(os.path.join(self.folder, segment), 'rb') as file:
+            file.seek(offset)
+            with gzip.GzipFile(fileobj=file) as member:
+                for i, recordLine in enumerate(member):
+                    if i == line:
+                        return json.loads(recordLine)
+
+    def segments(self, platform, since=None, until=None):
+        # Segment paths of the platform, oldest first, optionally only the dates from since to until (inclusive)
+        platformFolder = os.path.join(self.folder, platform)
+        if not os.path.isdir(platformFolder):
+            return []
+        paths = []
+        for date in sorted(os.listdir(platformFolder)):
+            if (since and date < since.isoformat()[:10]) or (until and date > until.isoformat()[:10]):
+                continue
+            for fileName in sorted(os.listdir(os.path.join(platformFolder, date))):
+                paths.append(os.path.join(platformFolder, date, fileName))
+        return paths
+
+    def records(self, platform, since=None, until=None):
+        for path in self.segments(platform, since, until):
+            # GzipFile reads the concatenated members as one stream
+            with gzip.open(path, 'rt', encoding='utf-8') as file:
+                for line in file:
+                    yield json.loads(line)
+
+
+archives = {}
+archivesLock = threading.Lock()
+
+
+def get_archive(config):
+    # One archive per folder, shared by the connectors of the process; None if 'archive folder' isn't configured
+    if not config.get('archive folder'):
+        return None
+    folder = os.path.join(application_path, config['archive folder'])
+    with archivesLock:
+        if folder not in archives:
+            archives[folder] = RawArchive(folder)
+        return archives[folder]
+
+
+def replay(connector, since=None, until=None, orderIds=None):
+    # Normalize the archived orders of the connector's platform again and write them to the database.
+    # No API calls: the details needed by the normalizer are in the archive. The records are read oldest first,
+    # so when an order was archived more than once its latest version is the one left in the database.
+    # The sync state is left as it is
+    archive = get_archive(connector.config)
+    if archive is None:
+        raise Exception('"archive folder" is not set in config.json')
+    writer = BatchWriter(connector.engine, connector.platform, connector.config.get('batch size', DEFAULT_BATCH_SIZE),
+                         connector.config.get('bulk load threshold'), connector.account)
+    if orderIds:
+        records = [archive.find(connector.key, orderId) for orderId in orderIds]
+        missing = [orderId for orderId, record in zip(orderIds, records) if record is None]
+        if missing:
+            print(f'Orders not in the {connector.name} archive: {", ".join(missing)}')
+        records = [record for record in records if record is not None]
+    else:
+        records = archive.records(connector.key, since, until)
+
+    try:
+        for record in records:
+            writer.add(*connector.normalize_order(record['order'], record['details']))
+        return writer.finish()
+    finally:
+        writer.close()
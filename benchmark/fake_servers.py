@@ -0,0 +1,214 @@
+import bisect, collections, datetime, json, random, threading, time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, urlencode
+
+# Stand-in eBay Fulfillment API, WooCommerce REST API and SP-API Orders API serving synthetic orders,
+# with the pagination of the real APIs (eBay "next", WooCommerce X-WP-Total/X-WP-TotalPages, Amazon NextToken),
+# a configurable latency per request and a share of the requests answered with 429
+
+
+def generate_orders(platform, count, seed=1):
+    # Orders are created one minute apart, ending now; the list is sorted from the oldest to the newest
+    randomGenerator = random.Random(f'{platform}-{seed}')
+    start = datetime.datetime.utcnow().replace(microsecond=0) - datetime.timedelta(minutes=count)
+    orders = []
+    for i in range(count):
+        created = start + datetime.timedelta(minutes=i)
+        items = []
+        for j in range(randomGenerator.randint(1, 3)):
+            items.append({
+                'id': f'{i}{j:02d}',
+                'sku': f'SKU-{randomGenerator.randint(1, 500)}',
+                'title': f'Product {randomGenerator.randint(1, 500)}',
+                'quantity': randomGenerator.randint(1, 4),
+                'price': randomGenerator.randint(100, 10000) / 100,
+                'tax': randomGenerator.randint(0, 500) / 100,
+            })
+        orders.append({'number': str(100000 + i), 'created': created, 'items': items,
+                       'delivery': randomGenerator.choice([0, 3.99, 5.5])})
+    return orders
+
+
+def ebay_order(order):
+    subtotal = round(sum(item['price'] * item['quantity'] for item in order['items']), 2)
+    tax = round(sum(item['tax'] for item in order['items']), 2)
+    return {
+        'orderId': f'01-{order["number"]}',
+        'creationDate': order['created'].isoformat() + '.000Z',
+        'lastModifiedDate': order['created'].isoformat() + '.000Z',
+        'buyer': {'username': f'buyer{order["number"]}'},
+        'pricingSummary': {
+            'priceSubtotal': {'value': str(subtotal)},
+            'deliveryCost': {'value': str(order['delivery'])},
+            'tax': {'value': str(tax)},
+            'total': {'value': str(round(subtotal + order['delivery'] + tax, 2))},
+        },
+        'lineItems': [{
+            'lineItemId': item['id'],
+            'sku': item['sku'],
+            'title': item['title'],
+            'quantity': item['quantity'],
+            'total': {'value': str(round(item['price'] * item['quantity'] + item['tax'], 2))},
+        } for item in order['items']],
+    }
+
+
+def wc_order(order):
+    subtotal = round(sum(item['price'] * item['quantity'] for item in order['items']), 2)
+    tax = round(sum(item['tax'] for item in order['items']), 2)
+    return {
+        'id': int(order['number']),
+        'number': order['number'],
+        'customer_id': int(order['number']) % 1000,
+        'date_created_gmt': order['created'].isoformat(),
+        'date_modified_gmt': order['created'].isoformat(),
+        'discount_total': '0.00',
+        'shipping_total': f'{order["delivery"]:.2f}',
+        'total_tax': f'{tax:.2f}',
+        'total': f'{subtotal + order["delivery"] + tax:.2f}',
+        'line_items': [{
+            'id': int(item['id']),
+            'sku': item['sku'],
+            'name': item['title'],
+            'quantity': item['quantity'],
+            'total': f'{item["price"] * item["quantity"]:.2f}',
+        } for item in order['items']],
+    }
+
+
+def amazon_order(order):
+    subtotal = round(sum(item['price'] * item['quantity'] for item in order['items']), 2)
+    tax = round(sum(item['tax'] * item['quantity'] for item in order['items']), 2)
+    return {
+        'AmazonOrderId': f'202-{order["number"]}',
+        'PurchaseDate': order['created'].isoformat() + 'Z',
+        'LastUpdateDate': order['created'].isoformat() + 'Z',
+        'FulfillmentInstruction': {'Name': f'buyer{order["number"]}'},
+        'OrderTotal': {'Amount': str(round(subtotal + tax, 2))},
+    }
+
+
+def amazon_order_items(order):
+    return [{
+        'OrderItemId': item['id'],
+        'SellerSKU': item['sku'],
+        'Title': item['title'],
+        'QuantityOrdered': item['quantity'],
+        'ItemPrice': {'Amount': str(item['price'])},
+        'ItemTax': {'Amount': str(item['tax'])},
+    } for item in order['items']]
+
+
+class FakeMarketplaces:
+    def __init__(self, ordersCount=1000, latency=0.0, throttleRate=0.0, amazonRate=50, seed=1):
+        self.latency = latency
+        self.throttleRate = throttleRate
+        self.amazonRate = amazonRate
+        self.random = random.Random(seed)
+        self.orders = {platform: generate_orders(platform, ordersCount, seed) for platform in ('ebay', 'wc', 'amazon')}
+        self.createdTimes = {platform: [order['created'] for order in orders] for platform, orders in self.orders.items()}
+        self.amazonOrders = {f'202-{order["number"]}': order for order in self.orders['amazon']}
+        self.calls = collections.Counter()
+        self.bytesSent = collections.Counter()
+        self.throttled = collections.Counter()
+        self.lock = threading.Lock()
+
+    def orders_after(self, platform, after):
+        # The orders created at or after the given UTC ISO timestamp, oldest first
+        orders = self.orders[platform]
+        if not after:
+            return orders
+        after = datetime.datetime.fromisoformat(after.rstrip('Z').split('+')[0])
+        return orders[bisect.bisect_left(self.createdTimes[platform], after):]
+
+    def handle(self, method, url, baseUrl):
+        # Returns (endpoint, status, headers, body) for the request
+        parsedUrl = urlparse(url)
+        path = parsedUrl.path
+        query = {key: values[0] for key, values in parse_qs(parsedUrl.query).items()}
+
+        if path == '/token':
+            return 'token', 200, {}, {'access_token': 'fake-token', 'refresh_token': 'fake-refresh', 'expires_in': 7200}
+
+        if path == '/sell/fulfillment/v1/order':
+            # eBay: newest first, "next" link while there are more orders
+            # The fake orders are never modified after their creation, both filters select by the creation date
+            after = None
+            if query.get('filter', '').startswith(('creationdate:[', 'lastmodifieddate:[')):
+                after = query['filter'].split(':[', 1)[1].split('..')[0]
+            orders = list(reversed(self.orders_after('ebay', after)))
+            limit = int(query.get('limit', 50))
+            offset = int(query.get('offset', 0))
+            body = {'total': len(orders), 'limit': limit, 'offset': offset,
+                    'orders': [ebay_order(order) for order in orders[offset:offset + limit]]}
+            if offset + limit < len(orders):
+                body['next'] = baseUrl + path + '?' + urlencode(dict(query, limit=limit, offset=offset + limit))
+            return 'ebay orders', 200, {}, body
+
+        if path == '/wp-json/wc/v3/orders':
+            # WooCommerce: newest first unless order=asc, page headers
+            orders = self.orders_after('wc', query.get('after') or query.get('modified_after'))
+            if query.get('order') != 'asc':
+                orders = list(reversed(orders))
+            perPage = int(query.get('per_page', 10))
+            page = int(query.get('page', 1))
+            headers = {'X-WP-Total': str(len(orders)), 'X-WP-TotalPages': str(-(-len(orders) // perPage))}
+            return 'wc orders', 200, headers, [wc_order(order) for order in orders[(page - 1) * perPage:page * perPage]]
+
+        if path.startswith('/orders/v0/orders'):
+            # Amazon: throttled like the SP-API, NextToken is the offset of the next page
+            headers = {'x-amzn-RateLimit-Limit': str(self.amazonRate)}
+            if self.random.random() < self.throttleRate:
+                with self.lock:
+                    self.throttled['amazon'] += 1
+                return 'amazon throttled', 429, headers, {'errors': [{'code': 'QuotaExceeded'}]}
+            if path.endswith('/orderItems'):
+                order = self.amazonOrders[path.split('/')[-2]]
+                return 'amazon orderItems', 200, headers, {'OrderItems': amazon_order_items(order)}
+            orders = self.orders_after('amazon', query.get('CreatedAfter') or query.get('LastUpdatedAfter'))
+            offset = int(query.get('NextToken', 0))
+            body = {'Orders': [amazon_order(order) for order in orders[offset:offset + 100]]}
+            if offset + 100 < len(orders):
+                body['NextToken'] = str(offset + 100)
+            return 'amazon orders', 200, headers, body
+
+        return 'not found', 404, {}, {'error': 'not found'}
+
+    def start(self, host='127.0.0.1', port=0):
+        marketplaces = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def respond(self):
+                if 'Content-Length' in self.headers:
+                    self.rfile.read(int(self.headers['Content-Length']))
+                if marketplaces.latency:
+                    time.sleep(marketplaces.latency)
+                endpoint, status, headers, body = marketplaces.handle(self.command, self.path, marketplaces.url)
+                payload = json.dumps(body).encode('utf-8')
+                with marketplaces.lock:
+                    marketplaces.calls[endpoint] += 1
+                    marketplaces.bytesSent[endpoint] += len(payload)
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = respond
+            do_POST = respond
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.url = f'http://{host}:{self.server.server_address[1]}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.url
+
+    def stop(self):
+        self.server.shutdown()
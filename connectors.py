@@ -0,0 +1,502 @@
+import datetime, base64, urllib, hashlib, json, time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from archive import get_archive
+from credentials import amazon_sign, account_config, account_key
+from database import get_sync_state, advance_sync_state, find_order_modifications
+from http_clients import get_session, endpoint_label, WooCommerceAPI
+from metrics import metrics, log_event
+from normalizers import normalize_ebay_order, normalize_wc_order, normalize_amazon_order, WC_ORDER_FIELDS
+from pipeline import prefetch
+from rate_limiter import get_limiter
+from writers import BatchWriter, DEFAULT_BATCH_SIZE
+
+# SP-API endpoints per AWS region
+# Amazon docs: https://github.com/amzn/selling-partner-api-docs/blob/main/guides/en-US/developer-guide/SellingPartnerApiDeveloperGuide.md#selling-partner-api-endpoints
+AMAZON_API_URLS = {
+    'us-east-1': 'https://sellingpartnerapi-na.amazon.com',  # North America
+    'eu-west-1': 'https://sellingpartnerapi-eu.amazon.com',  # Europe, Middle East, India
+    'us-west-2': 'https://sellingpartnerapi-fe.amazon.com',  # Far East
+}
+DEFAULT_AMAZON_REGION = 'eu-west-1'
+
+# getOrders returns at most 200 orders per page
+EBAY_MAX_PAGE_SIZE = 200
+
+
+class Connector:
+    # Common interface of the platforms: get_pages yields the pages of raw orders created after the watermark,
+    # get_details gets what else the normalizer needs from the API, normalize_order turns an order into rows,
+    # and sync runs the whole pipeline with its own batch writer
+    platform = None
+    name = None
+    defaultApiUrl = None
+
+    def __init__(self, config, credentials, engine, account=''):
+        # One connector per account of the platform (see credentials.platform_accounts)
+        self.config = config
+        self.account = account
+        self.key = account_key(self.platform, account)
+        if account:
+            self.name = f'{self.name} {account}'
+        self.platformConfig = account_config(config, self.platform, account)
+        self.credentials = credentials
+        self.engine = engine
+        self.session = get_session(self.platform, config, self.platformConfig)
+        # The API can be pointed to another host, e.g. to the local fake servers of the benchmark
+        self.apiUrl = self.platformConfig.get('api url', self.defaultApiUrl)
+        self.archive = get_archive(config)
+
+    def get_token(self):
+        # The token is kept in memory by the credentials cache until best_before
+        return self.credentials.get_token(self.platform, self.request_new_token, self.account)
+
+    def request_new_token(self, platform, platformConfig):
+        # eBay docs: https://developer.ebay.com/api-docs/static/oauth-refresh-token-request.html
+        # Amazon docs for refreshing token:
+        # https://github.com/amzn/selling-partner-api-docs/blob/main/guides/en-US/developer-guide/SellingPartnerApiDeveloperGuide.md#step-1-request-a-login-with-amazon-access-token
+        url = platformConfig['refresh_url']
+        if platform == 'amazon':
+            headers = {
+                'Host': 'api.amazon.com',
+                'Content-Type': 'application/x-www-form-urlencoded;charset=UTF-8',
+            }
+            data = {
+                'grant_type': 'refresh_token',
+                'refresh_token': platformConfig['refresh_token'],
+                'client_id': platformConfig['id'],
+                'client_secret': platformConfig['secret']
+            }
+        else:
+            headers = {
+                'Content-Type': 'application/x-www-form-urlencoded',
+                'Authorization': 'Basic ' + str(
+                    base64.b64encode((platformConfig['id'] + ':' +
+                                      platformConfig['secret']).encode('utf-8')), 'utf-8')
+            }
+            data = {
+                'grant_type': 'refresh_token',
+                'refresh_token': platformConfig['refresh_token'],
+                'scope': platformConfig['scope']
+            }
+        response = self.session.post(url, headers=headers, data=data)
+        response.raise_for_status()
+        return response.json()
+
+    def get_pages(self, syncState):
+        raise NotImplementedError
+
+    def get_changed_pages(self, modifiedSince):
+        # The pages of raw orders created or modified at or after modifiedSince (UTC ISO timestamp without Z)
+        raise NotImplementedError
+
+    def order_checkpoint(self, order):
+        # Returns (creation date, order ID, modification date) of the raw order, used to move the watermark
+        raise NotImplementedError
+
+    def get_details(self, orders):
+        # Raw data for each order beyond the order itself (e.g. the Amazon order items), archived with the order
+        return [None] * len(orders)
+
+    def normalize_order(self, order, details):
+        # Returns (order row, line item rows); no API calls, so the archived orders can be replayed
+        raise NotImplementedError
+
+    def fetch_concurrently(self, firstPage, pageRequests, workers):
+        # Yields the first page, then the pages returned by pageRequests (functions without arguments, called by
+        # the workers) as they arrive, so a slow page doesn't hold back the others; the order doesn't matter,
+        # the watermark is the newest order and the upserts drop the duplicates. At most two pages per worker
+        # are in flight, so a slow consumer doesn't make all the pages pile up in memory
+        yield firstPage
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = set()
+            for pageRequest in pageRequests:
+                pending.add(executor.submit(pageRequest))
+                if len(pending) >= workers * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+
+    def sync(self, stopEvent=None):
+        startTime = time.perf_counter()
+        pagesCount = 0
+        # Get only the orders created since the last synced one, or with "sync changes" the orders
+        # created or modified since the last sync, so the cancellations, refunds and edits are saved too
+        syncState = get_sync_state(self.engine, self.key)
+        modifiedSince = syncState['last_modified'] or syncState['last_created']
+        syncChanges = bool(self.platformConfig.get('sync changes') and modifiedSince)
+        pages = self.get_changed_pages(modifiedSince) if syncChanges else self.get_pages(syncState)
+        writer = BatchWriter(self.engine, self.platform, self.config.get('batch size', DEFAULT_BATCH_SIZE),
+                             self.config.get('bulk load threshold'), self.account)
+
+        try:
+            # The next pages are fetched while the current one is normalized and written
+            for page in prefetch(self.timed_pages(pages), self.config.get('prefetch pages', 2)):
+                if stopEvent is not None and stopEvent.is_set():
+                    # Shutting down: keep the written orders, but not the watermark, as the pages
+                    # aren't in creation order and the older orders may not be fetched yet
+                    writer.flush()
+                    return writer.ordersWritten
+                pagesCount += 1
+
+                # The filters include the orders at the watermark, skip those already in the database,
+                # and when syncing the changes only those saved with the same modification date
+                checkpoints = [self.order_checkpoint(order) for order in page]
+                savedModifications = find_order_modifications(self.engine, self.platform,
+                                                              [checkpoint[1] for checkpoint in checkpoints], self.account)
+                orders = [order for order, (_, orderId, modified) in zip(page, checkpoints)
+                          if orderId not in savedModifications
+                          or (syncChanges and savedModifications[orderId] != modified)]
+
+                with metrics.timer('phase_seconds', platform=self.platform, phase='details'):
+                    details = self.get_details(orders)
+                if self.archive is not None:
+                    with metrics.timer('phase_seconds', platform=self.platform, phase='archive'):
+                        self.archive.append(self.key, [self.order_checkpoint(order)[1] for order in orders],
+                                            orders, details)
+                with metrics.timer('phase_seconds', platform=self.platform, phase='normalize'):
+                    normalizedOrders = [self.normalize_order(order, orderDetails)
+                                        for order, orderDetails in zip(orders, details)]
+                for order, (orderRow, lineItemRows) in zip(orders, normalizedOrders):
+                    # Only the orders already saved have line items to replace
+                    writer.add(orderRow, lineItemRows, orderRow['order_id'] in savedModifications)
+                    advance_sync_state(syncState, *self.order_checkpoint(order))
+            ordersWritten = writer.finish(syncState)
+        finally:
+            # The spool files of a failed run are removed too
+            writer.close()
+
+        duration = time.perf_counter() - startTime
+        metrics.observe('sync_seconds', duration, platform=self.platform, account=self.account)
+        metrics.increment('orders_written_total', ordersWritten, platform=self.platform, account=self.account)
+        log_event('sync', platform=self.platform, account=self.account, changes=syncChanges, orders=ordersWritten, pages=pagesCount,
+                  seconds=round(duration, 3))
+        return ordersWritten
+
+    def timed_pages(self, pages):
+        # Time spent getting each page from the API (in the prefetch thread)
+        pages = iter(pages)
+        while True:
+            with metrics.timer('phase_seconds', platform=self.platform, phase='fetch'):
+                page = next(pages, None)
+            if page is None:
+                return
+            yield page
+
+
+class EbayConnector(Connector):
+    platform = 'ebay'
+    name = 'eBay'
+    defaultApiUrl = 'https://api.ebay.com'
+
+    def get_pages(self, syncState):
+        # API docs: https://developer.ebay.com/api-docs/sell/fulfillment/resources/order/methods/getOrders
+        params = {}
+        if syncState['last_created']:
+            params['filter'] = f"creationdate:[{syncState['last_created']}Z..]"
+        return self.get_order_pages(params)
+
+    def get_changed_pages(self, modifiedSince):
+        # The filter can't have both creationdate and lastmodifieddate
+        return self.get_order_pages({'filter': f'lastmodifieddate:[{modifiedSince}Z..]'})
+
+    def get_order_pages(self, params):
+        # The largest page eBay allows, and optionally "field groups" (e.g. TAX_BREAKDOWN)
+        params = dict(params, limit=self.platformConfig.get('page size', EBAY_MAX_PAGE_SIZE))
+        if self.platformConfig.get('field groups'):
+            params['fieldGroups'] = self.platformConfig['field groups']
+        url = self.apiUrl + '/sell/fulfillment/v1/order'
+
+        workers = self.platformConfig.get('page workers', 1)
+        if workers > 1:
+            yield from self.get_pages_concurrently(url, params, workers)
+            return
+
+        while url:
+            page = self.get_page(url, params)
+            yield page.get('orders', [])
+
+            # Continue getting the rest of the orders if there is a next page (the next URL keeps the filter)
+            url = page.get('next')
+            params = {}
+
+    def get_page(self, url, params):
+        if self.platformConfig.get('requests per second'):
+            # Optional limit of the getOrders calls of the account, e.g. to spread the daily call quota of the app
+            get_limiter('ebay getOrders', self.account, self.platformConfig['requests per second'],
+                        self.platformConfig.get('page workers', 1)).acquire()
+        # The token comes from the credentials cache in memory, and is refreshed there if it expires during the sync
+        headers = {
+            'Authorization': 'Bearer ' + self.get_token()
+        }
+        response = self.session.get(url, params=params, headers=headers)
+        response.raise_for_status()
+        return response.json()
+
+    def get_pages_concurrently(self, url, params, workers):
+        # The first page tells how many orders there are, the other pages are requested by offset.
+        # eBay returns the newest orders first, so the orders created during the sync shift the rest
+        # to later offsets: an order can come twice (it is written once), but none is skipped
+        page = self.get_page(url, dict(params, offset=0))
+        total = page.get('total', 0)
+        print(f'eBay orders to get: {total}')
+        pageRequests = (lambda offset=offset: self.get_page(url, dict(params, offset=offset)).get('orders', [])
+                        for offset in range(params['limit'], total, params['limit']))
+        return self.fetch_concurrently(page.get('orders', []), pageRequests, workers)
+
+    def order_checkpoint(self, order):
+        return order['creationDate'].strip('Z'), str(order['orderId']), order.get('lastModifiedDate', '').strip('Z')
+
+    def normalize_order(self, order, details):
+        return normalize_ebay_order(order)
+
+
+class WooCommerceConnector(Connector):
+    platform = 'wc'
+    name = 'WooCommerce'
+
+    def __init__(self, config, credentials, engine, account=''):
+        super().__init__(config, credentials, engine, account)
+        # How to get the keys: https://docs.woocommerce.com/document/woocommerce-rest-api/
+        self.wcapi = WooCommerceAPI(
+            self.session,
+            url=self.platformConfig['store url'],
+            consumer_key=self.platformConfig['consumer_key'],
+            consumer_secret=self.platformConfig['consumer_secret'],
+            wp_api=True,
+            version="wc/v3",
+            query_string_auth=True
+        )
+
+    def get_pages(self, syncState):
+        # API docs: https://woocommerce.github.io/woocommerce-rest-api-docs/?python#list-all-orders
+        params = {'per_page': 100}
+        if syncState['last_created']:
+            # "after" is exclusive, go one second back to include the orders created in the same second as the watermark
+            params['after'] = (datetime.datetime.fromisoformat(syncState['last_created'])
+                               - datetime.timedelta(seconds=1)).isoformat()
+            params['dates_are_gmt'] = 'true'
+        return self.get_order_pages(params)
+
+    def get_changed_pages(self, modifiedSince):
+        # modified_after needs WooCommerce 5.8 or newer; exclusive like "after"
+        params = {
+            'per_page': 100,
+            'modified_after': (datetime.datetime.fromisoformat(modifiedSince) - datetime.timedelta(seconds=1)).isoformat(),
+            'dates_are_gmt': 'true',
+            'orderby': 'modified',
+            'order': 'desc',
+        }
+        # Newest modification first and one page after another: an order modified during the sync moves to
+        # the first page and shifts the rest to later pages, so an order can come twice but none is skipped.
+        # Pages fetched concurrently in ascending order would skip the orders shifted to the fetched pages
+        return self.get_order_pages(params, concurrent=False)
+
+    def get_order_pages(self, params, concurrent=True):
+        if self.platformConfig.get('trim fields'):
+            # Transfer only the fields used by the normalizer
+            params['_fields'] = ','.join(WC_ORDER_FIELDS)
+
+        workers = self.platformConfig.get('page workers', 1)
+        if concurrent and workers > 1:
+            yield from self.get_pages_concurrently(params, workers)
+            return
+
+        i = 0
+        while True:
+            i += 1
+            response = self.get_page(params, i)
+            yield response.json()
+
+            # If less than 100 orders is returned, this is the last page
+            if len(response.json()) < 100:
+                return
+
+    def get_page(self, params, i):
+        response = self.wcapi.get("orders", params=dict(params, page=i))
+        response.raise_for_status()
+        return response
+
+    def get_pages_concurrently(self, params, workers):
+        # Oldest orders first by creation date: the orders created during the sync are added to the last page
+        # instead of shifting the orders between the pages which are being fetched (see get_changed_pages)
+        params = dict(params, orderby='date', order='asc')
+
+        # The first page tells how many pages there are
+        response = self.get_page(params, 1)
+        totalPages = int(response.headers.get('X-WP-TotalPages', 1))
+        print(f'WooCommerce orders to get: {response.headers.get("X-WP-Total")} in {totalPages} pages')
+        pageRequests = (lambda i=i: self.get_page(params, i).json() for i in range(2, totalPages + 1))
+        return self.fetch_concurrently(response.json(), pageRequests, workers)
+
+    def order_checkpoint(self, order):
+        return order['date_created_gmt'].strip('Z'), order['number'], (order.get('date_modified_gmt') or '').strip('Z')
+
+    def normalize_order(self, order, details):
+        return normalize_wc_order(order)
+
+
+class AmazonConnector(Connector):
+    # How to register a private app: https://github.com/amzn/selling-partner-api-docs/blob/main/guides/en-US/developer-guide/SellingPartnerApiDeveloperGuide.md
+    platform = 'amazon'
+    name = 'Amazon'
+
+    def __init__(self, config, credentials, engine, account=''):
+        super().__init__(config, credentials, engine, account)
+        # The AWS region of the account's marketplaces, which also selects the SP-API endpoint
+        self.region = self.platformConfig.get('region', DEFAULT_AMAZON_REGION)
+        self.apiUrl = self.platformConfig.get('api url', AMAZON_API_URLS[self.region])
+
+    def get_headers(self, url, params, method='GET', body=''):
+        requestTimestamp = datetime.datetime.utcnow().replace(microsecond=0).isoformat().replace('-', '').replace(':', '') + 'Z'
+
+        headers = {
+            'host': urllib.parse.urlparse(self.apiUrl).netloc,
+            'user-agent': 'Vanity Data/1.0 (Language=Python/3.8)',
+            'x-amz-access-token': self.get_token(),
+            'x-amz-date': requestTimestamp
+        }
+
+        # Amazon docs - Task 1: Create a canonical request for Signature Version 4
+        # https://docs.aws.amazon.com/general/latest/gr/sigv4-create-canonical-request.html
+        httpRequestMethod = method
+        canonicalURI = '/' + '/'.join(url.split('/')[3:])  # e. g. '/orders/v0/orders'
+
+        uriItems = []
+        for key in sorted(params):
+            uriItems.append(urllib.parse.quote(str(key)) + '=' + urllib.parse.quote(str(params[key])))
+        canonicalQueryString = '&'.join(uriItems)
+
+        canonicalHeaders = ''
+        for key, value in headers.items():
+            canonicalHeaders += key.lower() + ':' + value.strip() + '\n'
+
+        signedHeaders = (';'.join(sorted(headers))).lower()
+
+        hashOfPayload = hashlib.sha256(body.encode('utf-8')).hexdigest()
+        canonicalRequest = httpRequestMethod + '\n' + canonicalURI + '\n' + canonicalQueryString + '\n' + \
+                           canonicalHeaders + '\n' + signedHeaders + '\n' + hashOfPayload
+        canonicalRequestHash = hashlib.sha256(canonicalRequest.encode('utf-8')).hexdigest()
+
+        # Amazon docs - Task 2: Create a string to sign for Signature Version 4
+        # https://docs.aws.amazon.com/general/latest/gr/sigv4-create-string-to-sign.html
+        stringToSign = 'AWS4-HMAC-SHA256' + '\n' + \
+                       requestTimestamp + '\n' + \
+                       requestTimestamp[:8] + f'/{self.region}/execute-api/aws4_request' + '\n' + \
+                       canonicalRequestHash
+
+        # Amazon docs - Task 3: Calculate the signature for AWS Signature Version 4
+        # https://docs.aws.amazon.com/general/latest/gr/sigv4-calculate-signature.html
+        # The signing key is derived once per day and cached
+        kSigning = self.credentials.get_signing_key(self.platformConfig['aws_secret'], requestTimestamp[:8],
+                                                    self.region, 'execute-api')
+
+        signature = bytes.hex(amazon_sign(kSigning, stringToSign))
+
+        # Amazon docs - Task 4: Add the signature to the HTTP request
+        # https://docs.aws.amazon.com/general/latest/gr/sigv4-add-signature-to-request.html
+        credential = self.platformConfig['aws_id'] + '/' + requestTimestamp[:8] + f'/{self.region}/execute-api/aws4_request'
+        headers['Authorization'] = f'AWS4-HMAC-SHA256 ' \
+                                   f'Credential={credential}, ' \
+                                   f'SignedHeaders={signedHeaders}, ' \
+                                   f'Signature={signature}'
+
+        return headers
+
+    def get_resource(self, url, params, resource, operation):
+        items = []
+        for page in self.get_resource_pages(url, params, resource, operation):
+            items.extend(page)
+        return items
+
+    def get_resource_pages(self, url, params, resource, operation):
+        limiter = get_limiter(operation, self.account)
+
+        # Amazon docs about requests frequency:
+        # https://github.com/amzn/selling-partner-api-docs/blob/main/guides/en-US/usage-plans-rate-limits/Usage-Plans-and-Rate-Limits.md
+        while True:
+            response = self.request(url, params, limiter)
+            yield response.json()[resource]
+
+            # Continue getting the rest of the orders if there is a next page
+            if response.json().get('NextToken'):
+                params['NextToken'] = response.json().get('NextToken')
+            else:
+                return
+
+    def request(self, url, params, limiter, method='GET', payload=None):
+        # The payload of POST requests is sent as JSON and is a part of the signature
+        body = json.dumps(payload) if payload is not None else ''
+        throttled = False
+        while True:
+            # Wait for the token bucket instead of sleeping a fixed delay, so the requests go at the allowed rate
+            waitStart = time.perf_counter()
+            limiter.acquire()
+            waited = time.perf_counter() - waitStart
+            metrics.observe('rate_limiter_wait_seconds', waited, platform=self.platform, endpoint=endpoint_label(url))
+            if throttled:
+                metrics.increment('throttle_sleep_seconds_total', waited, platform=self.platform)
+            headers = self.get_headers(url, params, method, body)
+            if body:
+                headers['content-type'] = 'application/json'
+            response = self.session.request(method, url, params=params, headers=headers, data=body or None)
+
+            # Amazon returns the rate limit applied to this operation for the selling partner
+            if response.headers.get('x-amzn-RateLimit-Limit'):
+                limiter.update_rate(float(response.headers['x-amzn-RateLimit-Limit']))
+
+            if response.status_code == 429:
+                # If code is 429, Amazon throttles the API. Empty the bucket, so the next call waits for a new token
+                print(f'Amazon API throttles the requests, waiting {str(round(1 / limiter.rate, 1))} seconds to call API again')
+                limiter.drain()
+                metrics.increment('throttled_total', platform=self.platform)
+                throttled = True
+                continue
+            else:
+                # For other cases, check for errors and exit the loop
+                response.raise_for_status()
+                return response
+
+    def get_pages(self, syncState):
+        if not syncState['last_created'] and self.platformConfig.get('get orders after'):
+            # The checkpoint used to be kept in the config file
+            syncState['last_created'] = self.platformConfig['get orders after'].strip('Z')
+
+        # Collect Amazon orders from Orders API
+        # API docs: https://github.com/amzn/selling-partner-api-docs/blob/main/references/orders-api/ordersV0.md#getorders
+        # How to get the refresh token: https://github.com/amzn/selling-partner-api-docs/blob/main/guides/en-US/developer-guide/SellingPartnerApiDeveloperGuide.md#Self-authorization
+        url = self.apiUrl + '/orders/v0/orders'
+        if syncState['last_created']:
+            params = {
+                'CreatedAfter': syncState['last_created'] + 'Z'
+            }
+        else:
+            params = {}
+        return self.get_resource_pages(url, params, 'Orders', 'getOrders')
+
+    def get_changed_pages(self, modifiedSince):
+        # The order items of the changed orders are fetched again by get_details
+        url = self.apiUrl + '/orders/v0/orders'
+        return self.get_resource_pages(url, {'LastUpdatedAfter': modifiedSince + 'Z'}, 'Orders', 'getOrders')
+
+    def get_order_items(self, order):
+        url = f'{self.apiUrl}/orders/v0/orders/{order["AmazonOrderId"]}/orderItems'
+        return self.get_resource(url, {}, 'OrderItems', 'getOrderItems')
+
+    def order_checkpoint(self, order):
+        return order['PurchaseDate'].strip('Z'), order['AmazonOrderId'], order.get('LastUpdateDate', '').strip('Z')
+
+    def get_details(self, orders):
+        # Get the line items for the orders concurrently, the shared token bucket keeps the calls within the rate limits
+        with ThreadPoolExecutor(max_workers=self.platformConfig.get('order items workers', 8)) as executor:
+            return list(executor.map(self.get_order_items, orders))
+
+    def normalize_order(self, order, details):
+        return normalize_amazon_order(order, details)
+
+
+CONNECTORS = [EbayConnector, WooCommerceConnector, AmazonConnector]
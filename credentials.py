@@ -0,0 +1,135 @@
+import contextlib, datetime, json, os, sqlite3, threading, hashlib, hmac
+
+# Seconds a process waits for another one refreshing a token
+TOKEN_LOCK_TIMEOUT = 120
+
+
+def amazon_sign(key, msg):
+    return hmac.new(key, msg.encode('utf-8'), hashlib.sha256).digest()
+
+
+def platform_accounts(config, platform):
+    # A platform in config.json is one account (an object) or a list of accounts with different "account" names
+    accounts = config.get(platform, [])
+    return accounts if isinstance(accounts, list) else [accounts]
+
+
+def account_config(config, platform, account=''):
+    for accountConfig in platform_accounts(config, platform):
+        if accountConfig.get('account', '') == account:
+            return accountConfig
+    raise KeyError(f'No {platform} account "{account}" in config.json')
+
+
+def account_key(platform, account=''):
+    # Identifies the account in the sync state, the archive and the service status;
+    # just the platform for an account without a name, so the single account configs keep their state
+    return f'{platform}-{account}' if account else platform
+
+
+class TokenStore:
+    # The OAuth tokens of all the accounts in a SQLite file next to config.json, shared by the sync processes,
+    # the daemon and the OAuth app. SQLite locks the file across processes: a refresh runs inside
+    # BEGIN IMMEDIATE, so when a token expires only one process refreshes it and the others wait and reuse it.
+    # config.json itself is only read; the sync checkpoints are in the sync_state table of the database
+    def __init__(self, path):
+        self.path = path
+        with self.connect() as connection:
+            connection.execute(
+                """CREATE TABLE IF NOT EXISTS tokens
+                (
+                account_key TEXT NOT NULL,
+                access_token TEXT,
+                refresh_token TEXT,
+                best_before TEXT,
+                PRIMARY KEY (account_key)
+                );"""
+            )
+
+    @contextlib.contextmanager
+    def connect(self):
+        # A connection per use, so the store also works in the forked worker processes.
+        # isolation_level=None leaves the transactions to the explicit BEGIN statements
+        connection = sqlite3.connect(self.path, timeout=TOKEN_LOCK_TIMEOUT, isolation_level=None)
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    def get_token(self, key, accountConfig, request_new_token):
+        # Returns (access token, best before); accountConfig gives the first tokens of an account (the ones
+        # config.json used to keep) and the credentials for request_new_token(account config with the refresh token)
+        with self.connect() as connection:
+            connection.execute("BEGIN IMMEDIATE;")
+            try:
+                row = connection.execute("SELECT access_token, refresh_token, best_before FROM tokens WHERE account_key=?;",
+                                         (key,)).fetchone()
+                if row is None:
+                    row = (accountConfig.get('access_token'), accountConfig.get('refresh_token'),
+                           accountConfig.get('best_before') or datetime.datetime.min.isoformat())
+                accessToken, refreshToken, bestBefore = row
+                if datetime.datetime.utcnow() > datetime.datetime.fromisoformat(bestBefore):
+                    tokenResponse = request_new_token(dict(accountConfig, refresh_token=refreshToken))
+                    accessToken = tokenResponse['access_token']
+                    refreshToken = tokenResponse.get('refresh_token', refreshToken)
+                    bestBefore = token_best_before(tokenResponse)
+                connection.execute("INSERT OR REPLACE INTO tokens (account_key, access_token, refresh_token, best_before) "
+                                   "VALUES (?, ?, ?, ?);", (key, accessToken, refreshToken, bestBefore))
+                connection.execute("COMMIT;")
+            except:
+                connection.execute("ROLLBACK;")
+                raise
+        return accessToken, bestBefore
+
+    def save_token(self, key, tokenResponse):
+        # Used by the OAuth app when an account is authorized
+        with self.connect() as connection:
+            connection.execute("INSERT OR REPLACE INTO tokens (account_key, access_token, refresh_token, best_before) "
+                               "VALUES (?, ?, ?, ?);", (key, tokenResponse['access_token'],
+                                                        tokenResponse['refresh_token'], token_best_before(tokenResponse)))
+
+
+def token_best_before(tokenResponse):
+    # Refresh the token 5 minutes before it expires
+    return (datetime.datetime.utcnow() + datetime.timedelta(seconds=int(tokenResponse['expires_in']))
+            - datetime.timedelta(seconds=300)).isoformat()
+
+
+class CredentialCache:
+    # Keeps config.json and the access tokens in memory, so the API calls don't read files and re-derive keys
+    # on every request. The tokens are refreshed through the shared TokenStore
+    def __init__(self, configPath):
+        self.configPath = configPath
+        self.config = json.load(open(configPath))
+        self.tokenStore = TokenStore(os.path.join(os.path.dirname(os.path.abspath(configPath)),
+                                                  self.config.get('token store')
+                                                  or os.path.splitext(os.path.basename(configPath))[0] + ' tokens.sqlite'))
+        self.tokens = {}
+        self.signingKeys = {}
+        self.lock = threading.RLock()
+
+    def get_token(self, platform, request_new_token, account=''):
+        # The access token is valid until best_before, after that the token store calls
+        # request_new_token(platform, account config) once (the other threads and processes wait for it),
+        # which must return the JSON of the token response
+        key = account_key(platform, account)
+        with self.lock:
+            if key not in self.tokens or datetime.datetime.utcnow() > datetime.datetime.fromisoformat(self.tokens[key][1]):
+                self.tokens[key] = self.tokenStore.get_token(
+                    key, account_config(self.config, platform, account),
+                    lambda accountConfig: request_new_token(platform, accountConfig))
+            return self.tokens[key][0]
+
+    def get_signing_key(self, secret, dateStamp, region, service):
+        # Amazon docs - Task 3: the signing key depends only on the secret, the date, the region and the service
+        # https://docs.aws.amazon.com/general/latest/gr/sigv4-calculate-signature.html
+        key = (secret, dateStamp, region, service)
+        with self.lock:
+            if key not in self.signingKeys:
+                kDate = amazon_sign(('AWS4' + secret).encode('utf-8'), dateStamp)
+                kRegion = amazon_sign(kDate, region)
+                kService = amazon_sign(kRegion, service)
+                # Keys from the previous days are not needed anymore
+                self.signingKeys = {k: v for k, v in self.signingKeys.items() if k[1] == dateStamp}
+                self.signingKeys[key] = amazon_sign(kService, 'aws4_request')
+            return self.signingKeys[key]
@@ -0,0 +1,228 @@
+from sqlalchemy import text, bindparam
+
+from rollups import DAILY_SALES_INSERT, DAILY_SKU_SALES_INSERT
+
+
+# Versioned schema migrations, applied in order by migrate_schema. Never edit an applied migration, add a new one.
+# MySQL commits DDL statements implicitly, so the version is recorded after each migration.
+MIGRATIONS = [
+    # 1: the initial tables
+    (1, [
+        """CREATE TABLE IF NOT EXISTS orders
+        (
+        id INT NOT NULL AUTO_INCREMENT,
+        order_id VARCHAR(32),
+        platform VARCHAR(8),
+        creation_date VARCHAR(32),
+        customer_name VARCHAR(128),
+
+        subtotal_amount DECIMAL(9,2),
+        discount_amount DECIMAL(9,2),
+        delivery_amount DECIMAL(9,2),
+        tax_amount DECIMAL(9,2),
+        total_amount DECIMAL(9,2),
+
+        PRIMARY KEY (id)
+        );""",
+        """CREATE TABLE IF NOT EXISTS line_items
+        (
+        id INT NOT NULL AUTO_INCREMENT,
+        line_id VARCHAR(32),
+        order_id VARCHAR(32),
+        sku VARCHAR(64),
+        title VARCHAR(256),
+        quantity SMALLINT,
+        total_amount DECIMAL(9,2),
+        PRIMARY KEY (id)
+        );""",
+        # Sync state: the high watermark of every platform, so each run only asks for the orders after it.
+        # last_order_id is the order at the watermark, the orders with the same timestamp are deduplicated
+        """CREATE TABLE IF NOT EXISTS sync_state
+        (
+        platform VARCHAR(8) NOT NULL,
+        last_created VARCHAR(32),
+        last_modified VARCHAR(32),
+        last_order_id VARCHAR(32),
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+        PRIMARY KEY (platform)
+        );""",
+    ]),
+    # 2: unique keys for the upserts and indexes for the per-platform and per-date queries.
+    # The duplicates left by the reruns are removed first, the row inserted first is kept
+    (2, [
+        """DELETE duplicate FROM orders duplicate
+        JOIN orders original ON duplicate.platform = original.platform
+        AND duplicate.order_id = original.order_id AND duplicate.id > original.id;""",
+        """DELETE duplicate FROM line_items duplicate
+        JOIN line_items original ON duplicate.order_id = original.order_id
+        AND duplicate.line_id = original.line_id AND duplicate.id > original.id;""",
+        """ALTER TABLE orders
+        ADD UNIQUE KEY platform_order_id (platform, order_id),
+        ADD INDEX platform_creation_date (platform, creation_date),
+        ADD INDEX creation_date (creation_date);""",
+        """ALTER TABLE line_items
+        ADD UNIQUE KEY order_id_line_id (order_id, line_id),
+        ADD INDEX sku (sku);""",
+    ]),
+    # 3: order status, refunds and the modification date for the change sync
+    (3, [
+        """ALTER TABLE orders
+        ADD COLUMN status VARCHAR(32),
+        ADD COLUMN refund_amount DECIMAL(9,2),
+        ADD COLUMN modification_date VARCHAR(32);""",
+    ]),
+    # 4: several accounts per platform. The order IDs of different WooCommerce stores overlap, so the account
+    # is a part of the unique keys; the rows of the existing single accounts get the empty account name
+    (4, [
+        """ALTER TABLE sync_state MODIFY platform VARCHAR(48) NOT NULL;""",
+        """ALTER TABLE orders
+        ADD COLUMN account VARCHAR(32) NOT NULL DEFAULT '' AFTER platform,
+        DROP INDEX platform_order_id,
+        ADD UNIQUE KEY platform_account_order_id (platform, account, order_id);""",
+        """ALTER TABLE line_items
+        ADD COLUMN account VARCHAR(32) NOT NULL DEFAULT '' AFTER order_id,
+        DROP INDEX order_id_line_id,
+        ADD UNIQUE KEY account_order_id_line_id (account, order_id, line_id);""",
+    ]),
+    # 5: creation_date as DATETIME for the range queries, calculated by MySQL from the ISO string,
+    # and the daily rollups (see rollups.py), filled from the existing orders
+    (5, [
+        """ALTER TABLE orders
+        ADD COLUMN created_at DATETIME(3) AS (CAST(creation_date AS DATETIME(3))) STORED AFTER creation_date,
+        ADD INDEX platform_account_created_at (platform, account, created_at),
+        ADD INDEX created_at (created_at);""",
+        """CREATE TABLE IF NOT EXISTS daily_sales
+        (
+        sale_date DATE NOT NULL,
+        platform VARCHAR(8) NOT NULL,
+        account VARCHAR(32) NOT NULL,
+        orders_count INT NOT NULL,
+        subtotal_amount DECIMAL(12,2),
+        discount_amount DECIMAL(12,2),
+        delivery_amount DECIMAL(12,2),
+        tax_amount DECIMAL(12,2),
+        total_amount DECIMAL(12,2),
+        refund_amount DECIMAL(12,2),
+        PRIMARY KEY (sale_date, platform, account)
+        );""",
+        """CREATE TABLE IF NOT EXISTS daily_sku_sales
+        (
+        sale_date DATE NOT NULL,
+        platform VARCHAR(8) NOT NULL,
+        account VARCHAR(32) NOT NULL,
+        sku VARCHAR(64) NOT NULL,
+        orders_count INT NOT NULL,
+        quantity INT NOT NULL,
+        total_amount DECIMAL(12,2),
+        PRIMARY KEY (sale_date, platform, account, sku),
+        INDEX sku_sale_date (sku, sale_date)
+        );""",
+        DAILY_SALES_INSERT.format(where='created_at IS NOT NULL'),
+        DAILY_SKU_SALES_INSERT.format(where='orders.created_at IS NOT NULL'),
+    ]),
+    # 6: a version per platform, increased by every write batch, so the caches of the read API
+    # (in another process) know when their results are outdated
+    (6, [
+        """CREATE TABLE IF NOT EXISTS data_versions
+        (
+        platform VARCHAR(8) NOT NULL,
+        version BIGINT NOT NULL,
+        PRIMARY KEY (platform)
+        );""",
+    ]),
+]
+
+
+def migrate_schema(engine):
+    # Bring the database to the latest schema version. The named lock keeps two processes
+    # from applying the same migration at the same time
+    with engine.connect() as connection:
+        connection.execute(text("SELECT GET_LOCK('schema_migrations', 60);"))
+        try:
+            connection.execute(text(
+                """CREATE TABLE IF NOT EXISTS schema_migrations
+                (
+                version INT NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (version)
+                );"""
+            ))
+            currentVersion = connection.execute(text("SELECT MAX(version) FROM schema_migrations;")).scalar() or 0
+            for version, statements in MIGRATIONS:
+                if version <= currentVersion:
+                    continue
+                for statement in statements:
+                    connection.execute(text(statement))
+                connection.execute(text("INSERT INTO schema_migrations (version) VALUES (:version);"),
+                                   {'version': version})
+                print(f'Database schema migrated to version {version}')
+        finally:
+            connection.execute(text("SELECT RELEASE_LOCK('schema_migrations');"))
+
+
+def get_sync_state(engine, platform):
+    # Returns a dictionary with last_created, last_modified and last_order_id (None for the first run);
+    # platform is the account key of credentials.account_key
+    with engine.connect() as connection:
+        row = connection.execute(text(
+            "SELECT last_created, last_modified, last_order_id FROM sync_state WHERE platform=:platform;"
+        ), {'platform': platform}).fetchone()
+    if row is None:
+        return {'last_created': None, 'last_modified': None, 'last_order_id': None}
+    return {'last_created': row[0], 'last_modified': row[1], 'last_order_id': row[2]}
+
+
+def save_sync_state(connection, platform, state):
+    connection.execute(text(
+        """INSERT INTO sync_state (platform, last_created, last_modified, last_order_id)
+        VALUES (:platform, :last_created, :last_modified, :last_order_id)
+        ON DUPLICATE KEY UPDATE
+        last_created=VALUES(last_created), last_modified=VALUES(last_modified), last_order_id=VALUES(last_order_id);"""
+    ), dict(state, platform=platform))
+
+
+def advance_sync_state(state, creationDate, orderId, modifiedDate=None):
+    # Move the watermark forward if the order is newer than it
+    # (the timestamps are UTC ISO strings in the same format per platform, so they compare as strings)
+    if state['last_created'] is None or creationDate > state['last_created']:
+        state['last_created'] = creationDate
+        state['last_order_id'] = orderId
+    if modifiedDate and (state['last_modified'] is None or modifiedDate > state['last_modified']):
+        state['last_modified'] = modifiedDate
+
+
+def increase_data_version(connection, platform):
+    connection.execute(text(
+        "INSERT INTO data_versions (platform, version) VALUES (:platform, 1) ON DUPLICATE KEY UPDATE version=version+1;"
+    ), {'platform': platform})
+
+
+def get_data_versions(engine):
+    # Returns {platform: version}
+    with engine.connect() as connection:
+        return dict(connection.execute(text("SELECT platform, version FROM data_versions;")).fetchall())
+
+
+def find_order_modifications(engine, platform, orderIds, account=''):
+    # Returns {order ID: modification date} of the fetched orders already in the database
+    if not orderIds:
+        return {}
+    with engine.connect() as connection:
+        result = connection.execute(text(
+            """SELECT order_id, modification_date FROM orders
+            WHERE platform=:platform AND account=:account AND order_id IN :orderIds;"""
+        ).bindparams(bindparam('orderIds', expanding=True)),
+            {'platform': platform, 'account': account, 'orderIds': list(orderIds)})
+        return {row[0]: row[1] for row in result.fetchall()}
+
+
+def find_known_order_ids(engine, platform, orderIds, account=''):
+    # Deduplicate in the database: only the IDs of the fetched orders are looked up
+    if not orderIds:
+        return set()
+    with engine.connect() as connection:
+        result = connection.execute(text(
+            "SELECT order_id FROM orders WHERE platform=:platform AND account=:account AND order_id IN :orderIds;"
+        ).bindparams(bindparam('orderIds', expanding=True)),
+            {'platform': platform, 'account': account, 'orderIds': list(orderIds)})
+        return set(row[0] for row in result.fetchall())
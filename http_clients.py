@@ -0,0 +1,124 @@
+import threading, json, re, time
+from urllib.parse import urlencode, urlparse
+
+import requests
+from requests.auth import HTTPBasicAuth
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from woocommerce import API
+
+from metrics import metrics
+
+# Can be overridden for all platforms in config['http'] or for one platform account in its 'http'
+DEFAULT_HTTP_SETTINGS = {
+    'pool size': 10,
+    'connect timeout': 5,
+    'read timeout': 60,
+    'retries': 3,
+    'backoff factor': 0.5,
+}
+
+
+class PlatformSession(requests.Session):
+    # A session keeps the TCP+TLS connections to the platform alive between the calls,
+    # so only the first request of a run pays for the handshake
+    def __init__(self, settings, platform):
+        super().__init__()
+        self.platform = platform
+        self.timeout = (settings['connect timeout'], settings['read timeout'])
+
+        # Retry the connection errors and the server errors. 429 is not retried here,
+        # Amazon throttling is handled by the token buckets in rate_limiter.py
+        retry = Retry(total=settings['retries'],
+                      backoff_factor=settings['backoff factor'],
+                      status_forcelist=(500, 502, 503, 504),
+                      allowed_methods=frozenset(['GET', 'POST']),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=settings['pool size'],
+                              pool_maxsize=settings['pool size'],
+                              max_retries=retry)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        endpoint = endpoint_label(url)
+        startTime = time.perf_counter()
+        try:
+            response = super().request(method, url, **kwargs)
+        except:
+            metrics.increment('http_requests_total', platform=self.platform, endpoint=endpoint, status='error')
+            raise
+        metrics.observe('http_request_seconds', time.perf_counter() - startTime, platform=self.platform, endpoint=endpoint)
+        metrics.increment('http_requests_total', platform=self.platform, endpoint=endpoint, status=response.status_code)
+        # The streamed downloads aren't read yet, their size is known only from the header
+        if kwargs.get('stream'):
+            responseBytes = int(response.headers.get('Content-Length', 0))
+        else:
+            responseBytes = len(response.content)
+        metrics.increment('http_response_bytes_total', responseBytes, platform=self.platform, endpoint=endpoint)
+        return response
+
+
+def endpoint_label(url):
+    # The path of the URL with the IDs replaced, e.g. /orders/v0/orders/{id}/orderItems,
+    # so the metrics have one series per endpoint and not per order
+    segments = []
+    for segment in urlparse(url).path.split('/'):
+        if len(re.findall(r'\d', segment)) >= 5 and not re.fullmatch(r'\d{4}-\d{2}-\d{2}', segment):
+            segment = '{id}'
+        segments.append(segment)
+    return '/'.join(segments)
+
+
+sessions = {}
+sessionsLock = threading.Lock()
+
+
+def get_session(platform, config, accountConfig):
+    # One shared session per platform account
+    key = (platform, accountConfig.get('account', ''))
+    with sessionsLock:
+        if key not in sessions:
+            settings = dict(DEFAULT_HTTP_SETTINGS)
+            settings.update(config.get('http', {}))
+            settings.update(accountConfig.get('http', {}))
+            sessions[key] = PlatformSession(settings, platform)
+        return sessions[key]
+
+
+class WooCommerceAPI(API):
+    # The woocommerce package sends every call with requests.request, i.e. with a new connection each time.
+    # This replaces its private request method to send the same request through the pooled session.
+    def __init__(self, session, **kwargs):
+        kwargs.setdefault('timeout', session.timeout)
+        super().__init__(**kwargs)
+        self.session = session
+
+    def _API__request(self, method, endpoint, data, params=None, **kwargs):
+        if params is None:
+            params = {}
+        url = self._API__get_url(endpoint)
+        auth = None
+        headers = {
+            'user-agent': self.user_agent,
+            'accept': 'application/json'
+        }
+
+        if self.is_ssl and not self.query_string_auth:
+            auth = HTTPBasicAuth(self.consumer_key, self.consumer_secret)
+        elif self.is_ssl and self.query_string_auth:
+            params.update({
+                'consumer_key': self.consumer_key,
+                'consumer_secret': self.consumer_secret
+            })
+        else:
+            url = self._API__get_oauth_url(url + '?' + urlencode(params), method, **kwargs)
+            params = {}
+
+        if data is not None:
+            data = json.dumps(data, ensure_ascii=False).encode('utf-8')
+            headers['content-type'] = 'application/json;charset=utf-8'
+
+        return self.session.request(method=method, url=url, verify=self.verify_ssl, auth=auth, params=params,
+                                    data=data, timeout=self.timeout, headers=headers)
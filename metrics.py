@@ -0,0 +1,101 @@
+import contextlib, datetime, json, logging, os, tempfile, threading, time
+
+PREFIX = 'orders_sync_'
+
+
+class Metrics:
+    # Counters and summaries (count, sum, max) keyed by the metric name and its labels,
+    # exported as structured JSON log lines and in the Prometheus text format
+    # Prometheus docs: https://prometheus.io/docs/instrumenting/exposition_formats/
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.summaries = {}
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            summary = self.summaries.setdefault(key, [0, 0.0, value])
+            summary[0] += 1
+            summary[1] += value
+            summary[2] = max(summary[2], value)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        startTime = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - startTime, **labels)
+
+    def snapshot(self, reset=False):
+        with self.lock:
+            snapshot = {
+                'counters': [dict(labels, metric=name, value=value) for (name, labels), value in self.counters.items()],
+                'summaries': [dict(labels, metric=name, count=summary[0], sum=round(summary[1], 6), max=round(summary[2], 6))
+                              for (name, labels), summary in self.summaries.items()],
+            }
+            if reset:
+                self.counters = {}
+                self.summaries = {}
+            return snapshot
+
+    def merge(self, snapshot):
+        # Adds a snapshot taken in another process, e.g. by a sync worker process
+        with self.lock:
+            for counter in snapshot['counters']:
+                labels = {key: value for key, value in counter.items() if key not in ('metric', 'value')}
+                key = (counter['metric'], tuple(sorted(labels.items())))
+                self.counters[key] = self.counters.get(key, 0) + counter['value']
+            for summary in snapshot['summaries']:
+                labels = {key: value for key, value in summary.items() if key not in ('metric', 'count', 'sum', 'max')}
+                key = (summary['metric'], tuple(sorted(labels.items())))
+                current = self.summaries.setdefault(key, [0, 0.0, summary['max']])
+                current[0] += summary['count']
+                current[1] += summary['sum']
+                current[2] = max(current[2], summary['max'])
+
+    def to_prometheus(self):
+        lines = []
+        with self.lock:
+            for metricType, metrics in (('counter', self.counters), ('summary', self.summaries)):
+                for name in sorted(set(name for name, _ in metrics)):
+                    lines.append(f'# TYPE {PREFIX}{name} {metricType}')
+                    for (metricName, labels), value in sorted(metrics.items()):
+                        if metricName != name:
+                            continue
+                        labelsText = prometheus_labels(labels)
+                        if metricType == 'counter':
+                            lines.append(f'{PREFIX}{name}{labelsText} {value}')
+                        else:
+                            lines.append(f'{PREFIX}{name}_count{labelsText} {value[0]}')
+                            lines.append(f'{PREFIX}{name}_sum{labelsText} {value[1]}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus_file(self, path):
+        # Atomic rename, so a scraper (e.g. the node exporter textfile collector) never reads half a file
+        fileDescriptor, tempPath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+        with os.fdopen(fileDescriptor, 'w') as file:
+            file.write(self.to_prometheus())
+        os.replace(tempPath, path)
+
+
+def prometheus_labels(labels):
+    if not labels:
+        return ''
+    escaped = [(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for key, value in labels]
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+def log_event(event, **fields):
+    # One JSON object per line in the daily log file
+    logging.info(json.dumps(dict(event=event, time=datetime.datetime.utcnow().isoformat(), **fields), default=str))
+
+
+# Shared by all the connectors of the process
+metrics = Metrics()
@@ -0,0 +1,156 @@
+from decimal import Decimal, ROUND_HALF_UP
+
+
+# Each normalizer turns one order from the platform API into a row for the orders table
+# and a list of rows for the line_items table
+
+
+def to_cents(amount):
+    # Money amount of the APIs (a string like "12.30", or a number) in integer cents, so the totals are
+    # added and subtracted exactly instead of accumulating float rounding errors.
+    # The decimal string is parsed exactly, more than 2 decimals are rounded half up
+    return int((Decimal(str(amount)) * 100).quantize(Decimal(1), ROUND_HALF_UP))
+
+
+def from_cents(cents):
+    # Cents to the amount written to the DECIMAL(9,2) columns; the division gives the nearest float to the cents
+    return cents / 100
+
+
+def normalize_ebay_order(order):
+    pricingSummary = order['pricingSummary']
+    orderRow = {
+        'order_id': str(order['orderId']),
+        'platform': 'ebay',
+        'creation_date': order['creationDate'].strip('Z'),
+        # saves UTC ISO timestamp, example: 2015-08-04T19:09:02.768
+        'customer_name': order['buyer']['username'][:128],
+        'subtotal_amount': from_cents(to_cents(pricingSummary.get('priceSubtotal', {'value': '0.0'})['value'])),
+        'discount_amount': from_cents(to_cents(pricingSummary.get('priceDiscountSubtotal', {'value': '0.0'})['value'])),
+        'delivery_amount': from_cents(to_cents(pricingSummary.get('deliveryCost', {'value': '0.0'})['value'])),
+        'tax_amount': from_cents(to_cents(pricingSummary.get('tax', {'value': '0.0'})['value'])),
+        'total_amount': from_cents(to_cents(pricingSummary.get('total', {'value': '0.0'})['value'])),
+        'status': ebay_order_status(order),
+        # Only the refunds paid back, not those pending or failed
+        'refund_amount': from_cents(sum(to_cents(refund['amount']['value'])
+                                        for refund in order.get('paymentSummary', {}).get('refunds', [])
+                                        if refund.get('refundStatus') == 'REFUNDED')),
+        'modification_date': order.get('lastModifiedDate', order['creationDate']).strip('Z'),
+    }
+    lineItemRows = []
+    for item in order['lineItems']:
+        lineItemRows.append({
+            'line_id': str(item['lineItemId']),
+            'order_id': order['orderId'],
+            'sku': item.get('sku', ''),
+            'title': item['title'][:256],
+            'quantity': item['quantity'],
+            'total_amount': from_cents(to_cents(item['total']['value'])),
+        })
+    return orderRow, lineItemRows
+
+
+def ebay_order_status(order):
+    # eBay has separate fulfillment, payment and cancellation statuses, the cancellation and refunds come first
+    # Docs: https://developer.ebay.com/api-docs/sell/fulfillment/types/sel:OrderFulfillmentStatus
+    if order.get('cancelStatus', {}).get('cancelState') == 'CANCELED':
+        return 'CANCELED'
+    if order.get('orderPaymentStatus') in ('FULLY_REFUNDED', 'PARTIALLY_REFUNDED'):
+        return order['orderPaymentStatus']
+    return order.get('orderFulfillmentStatus')
+
+
+# The WooCommerce order fields read by normalize_wc_order and the sync, requested with _fields= to trim the payload
+WC_ORDER_FIELDS = ['number', 'customer_id', 'date_created_gmt', 'date_modified_gmt', 'status',
+                   'discount_total', 'shipping_total', 'total_tax', 'total', 'line_items', 'refunds']
+
+
+def normalize_wc_order(order):
+    discount = to_cents(order['discount_total'])
+    delivery = to_cents(order['shipping_total'])
+    tax = to_cents(order['total_tax'])
+    total = to_cents(order['total'])
+    orderRow = {
+        'order_id': order['number'],
+        'platform': 'wc',
+        'creation_date': order['date_created_gmt'].strip('Z'),
+        # saves UTC ISO timestamp, example: 2015-08-04T19:09:02
+        'customer_name': str(order['customer_id'])[:128],
+        'subtotal_amount': from_cents(total - tax - delivery + discount),
+        'discount_amount': from_cents(discount),
+        'delivery_amount': from_cents(delivery),
+        'tax_amount': from_cents(tax),
+        'total_amount': from_cents(total),
+        'status': order.get('status'),
+        # The refunds are listed with negative totals
+        'refund_amount': from_cents(sum(abs(to_cents(refund['total'])) for refund in order.get('refunds', []))),
+        'modification_date': (order.get('date_modified_gmt') or order['date_created_gmt']).strip('Z'),
+    }
+    lineItemRows = []
+    for item in order['line_items']:
+        lineItemRows.append({
+            'line_id': str(item['id']),
+            'order_id': order['number'],
+            'sku': item.get('sku', ''),
+            'title': item['name'][:256],
+            'quantity': item['quantity'],
+            'total_amount': from_cents(to_cents(item['total'])),
+        })
+    return orderRow, lineItemRows
+
+
+def amazon_cents(item, field):
+    # The Amazon money fields are objects like {"CurrencyCode": "EUR", "Amount": "12.30"} and are left out when empty
+    money = item.get(field)
+    return to_cents(money['Amount']) if money else 0
+
+
+def normalize_amazon_order(order, lineItems):
+    # Amazon doesn't return the order figures, they are calculated from the line items
+    # Set the initial values for order figures calculation (in cents)
+    subtotal = 0
+    discount = 0
+    delivery = 0
+    tax = 0
+
+    lineItemRows = []
+    for item in lineItems:
+        quantity = int(item['QuantityOrdered'])
+        itemSubtotal = amazon_cents(item, 'ItemPrice') * quantity
+        itemDiscount = amazon_cents(item, 'PromotionDiscount')
+        itemDelivery = amazon_cents(item, 'ShippingPrice') + amazon_cents(item, 'ShippingDiscount')
+        itemTax = amazon_cents(item, 'ItemTax') * quantity + amazon_cents(item, 'ShippingTax') - \
+                  amazon_cents(item, 'ShippingDiscountTax') - amazon_cents(item, 'PromotionDiscountTax')
+
+        itemTotal = itemSubtotal - itemDiscount + itemDelivery + itemTax
+
+        lineItemRows.append({
+            'line_id': str(item['OrderItemId']),
+            'order_id': order['AmazonOrderId'],
+            'sku': item.get('SellerSKU', ''),
+            'title': item['Title'][:256],
+            'quantity': item['QuantityOrdered'],
+            'total_amount': from_cents(itemTotal),
+        })
+
+        subtotal += itemSubtotal
+        discount += itemDiscount
+        delivery += itemDelivery
+        tax += itemTax
+
+    orderRow = {
+        'order_id': str(order['AmazonOrderId']),
+        'platform': 'amazon',
+        'creation_date': order['PurchaseDate'].strip('Z'),  # saves UTC ISO timestamp, example: 2015-08-04T19:09:02.768
+        'customer_name': order['FulfillmentInstruction']['Name'][:128],
+        'subtotal_amount': from_cents(subtotal),
+        'discount_amount': from_cents(discount),
+        'delivery_amount': from_cents(delivery),
+        'tax_amount': from_cents(tax),
+        'total_amount': from_cents(amazon_cents(order, 'OrderTotal')),
+        'status': order.get('OrderStatus'),
+        # The refunds are only in the Finances API, not in the Orders API
+        'refund_amount': None,
+        'modification_date': order.get('LastUpdateDate', order['PurchaseDate']).strip('Z'),
+    }
+    return orderRow, lineItemRows
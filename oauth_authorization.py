@@ -1,5 +1,13 @@
 from flask import Flask, request, redirect
-import requests, base64, json, datetime, os, traceback, logging
+import base64, datetime, os, traceback, logging
+
+from connectors import EbayConnector
+from credentials import CredentialCache, platform_accounts, account_config, account_key
+from http_clients import get_session
+from main import create_database_engine
+from metrics import metrics
+from read_api import create_read_api
+from webhooks import verify_wc_signature, start_webhook_worker, WC_ORDER_TOPICS
 
 app = Flask(__name__)
 
@@ -9,9 +17,16 @@ logs_folder = 'logs for the last 20 days'
 if logs_folder not in os.listdir(application_path):
     os.mkdir(os.path.join(application_path, logs_folder))
 
-config = json.load(open(os.path.join(application_path, 'config.json')))
+# The tokens go to the token store shared with the sync, config.json isn't written
+credentials = CredentialCache(os.path.join(application_path, 'config.json'))
+config = credentials.config
+
+# One redirect URL for all the eBay accounts, the account to authorize is chosen with ?account=<name>
+# and comes back from eBay in the state
+authSlug = platform_accounts(config, 'ebay')[0]['auth_slug']
 
-@app.route(config['ebay']['auth_slug'])
+
+@app.route(authSlug)
 def ebay_authorization():
     logName = os.path.join(application_path, logs_folder, 'log ' + datetime.datetime.now().strftime('%Y-%m-%d') + '.txt')
     logging.basicConfig(filename=logName, level=logging.INFO, format=' %(asctime)s -  %(levelname)s -  %(message)s')
@@ -20,27 +35,28 @@ def ebay_authorization():
     # check if user returned from the authorization page with the code
     authCode = request.args.get('code')
     if authCode:
+        account = request.args.get('state', '')
+        ebayConfig = account_config(config, 'ebay', '' if account == 'ProductionAuth' else account)
         try:
             responseStr = ''
             # send the code to get the token
             headers = {
                 'Content-Type': 'application/x-www-form-urlencoded',
-                'Authorization': 'Basic ' + str(base64.b64encode((config['ebay']['id'] + ':' + config['ebay']['secret']).encode("utf-8")), "utf-8")
+                'Authorization': 'Basic ' + str(base64.b64encode((ebayConfig['id'] + ':' + ebayConfig['secret']).encode("utf-8")), "utf-8")
             }
             payload = {
                 'code': authCode,
-                'redirect_uri': config['redirect_uri'] + config['ebay']['auth_slug'],
+                'redirect_uri': config['redirect_uri'] + authSlug,
                 'grant_type': 'authorization_code'
             }
-            response = requests.post(f'https://api.ebay.com/identity/v1/oauth2/token', data=payload, headers=headers)
+            # Through the pooled session of the account with its timeouts and retries, to its "api url" if set
+            session = get_session('ebay', config, ebayConfig)
+            response = session.post(ebayConfig.get('api url', EbayConnector.defaultApiUrl) + '/identity/v1/oauth2/token',
+                                    data=payload, headers=headers)
 
             responseStr = str(response.json())
-            config['ebay']['access_token'] = response.json()['access_token']
-            config['ebay']['refresh_token'] = response.json()['refresh_token']
-            config['ebay']['best_before'] = (datetime.datetime.utcnow()
-                                             + datetime.timedelta(seconds=int(response.json()['expires_in']))
-                                             - datetime.timedelta(seconds=300)).isoformat()
-            json.dump(config, open('config.json', 'w'))
+            response.raise_for_status()
+            credentials.tokenStore.save_token(account_key('ebay', ebayConfig.get('account', '')), response.json())
 
             return f'\n\nThe app is authorized, thank you.\n\nYou can close this tab now.'
         except:
@@ -48,17 +64,54 @@ def ebay_authorization():
             logging.error(responseStr)
             raise Exception(traceback.format_exc())
     else:
+        ebayConfig = account_config(config, 'ebay', request.args.get('account', ''))
         # send the authorization request to get the code
         redirectUrl = f'https://auth.ebay.com/oauth2/authorize?' \
-                      f'client_id={config["ebay"]["id"]}&' \
-                      f'redirect_uri={config["redirect_uri"]}{config["ebay"]["auth_slug"]}&' \
+                      f'client_id={ebayConfig["id"]}&' \
+                      f'redirect_uri={config["redirect_uri"]}{authSlug}&' \
                       f'response_type=code&' \
-                      f'state=ProductionAuth&' \
-                      f'scope={config["ebay"]["scope"]}&' \
+                      f'state={ebayConfig.get("account") or "ProductionAuth"}&' \
+                      f'scope={ebayConfig["scope"]}&' \
                       f'prompt=login'
         return redirect(redirectUrl)
 
 
+# WooCommerce webhooks: add a webhook for order.created and one for order.updated in WooCommerce >
+# Settings > Advanced > Webhooks, both with this delivery URL and the "webhook secret" of the config.
+# Every store has its own URL, /webhooks/woocommerce/<account> for the named accounts
+def wc_webhook_handler(accountConfig, webhookQueue):
+    def wc_webhook():
+        topic = request.headers.get('X-WC-Webhook-Topic')
+        if topic is None:
+            # The ping sent when the webhook is created has no topic
+            return '', 200
+        body = request.get_data()
+        if not verify_wc_signature(body, request.headers.get('X-WC-Webhook-Signature'), accountConfig['webhook secret']):
+            logging.warning(f'WooCommerce webhook with an invalid signature rejected, topic {topic}')
+            return 'Invalid signature', 401
+        if topic in WC_ORDER_TOPICS:
+            webhookQueue.put(topic, body.decode('utf-8'))
+            metrics.increment('webhooks_received_total', platform='wc', account=accountConfig.get('account', ''), topic=topic)
+        # Other topics are acknowledged, so WooCommerce doesn't disable the webhook after failed deliveries
+        return '', 200
+    return wc_webhook
+
+
+webhookAccounts = [accountConfig for accountConfig in platform_accounts(config, 'wc') if accountConfig.get('webhook secret')]
+# One pooled engine for the webhook workers and the read API
+engine = create_database_engine(config) if webhookAccounts or 'read api' in config else None
+for accountConfig in webhookAccounts:
+    account = accountConfig.get('account', '')
+    slug = accountConfig.get('webhook slug', '/webhooks/woocommerce' + (f'/{account}' if account else ''))
+    app.add_url_rule(slug, f'wc_webhook_{account}', methods=['POST'],
+                     view_func=wc_webhook_handler(accountConfig, start_webhook_worker(config, engine, account)))
+
+# Read-only JSON API over the synced orders, enabled with a "read api" object in the config with a "token",
+# the shared secret sent by the clients as Authorization: Bearer <token>
+if 'read api' in config:
+    app.register_blueprint(create_read_api(engine, config))
+
+
 @app.route('/')
 def hello_world():
     return 'Hello World, everyone!'
@@ -0,0 +1,40 @@
+import queue, threading
+
+
+def prefetch(pages, depth=2):
+    # Iterate over the pages generator in a background thread, so up to `depth` next pages
+    # are being fetched while the current one is normalized and written
+    pageQueue = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        # Give up if the consumer has stopped reading, otherwise the thread would wait forever
+        while not stop.is_set():
+            try:
+                pageQueue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for page in pages:
+                if not put(('page', page)):
+                    return
+            put(('done', None))
+        except Exception as error:
+            put(('error', error))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            kind, value = pageQueue.get()
+            if kind == 'done':
+                return
+            if kind == 'error':
+                raise value
+            yield value
+    finally:
+        stop.set()
@@ -0,0 +1,69 @@
+import threading, time
+
+# Default SP-API usage plans per operation: (requests per second, burst)
+# Amazon docs: https://github.com/amzn/selling-partner-api-docs/blob/main/references/orders-api/ordersV0.md
+AMAZON_RATE_LIMITS = {
+    'getOrders': (0.0167, 20),
+    'getOrder': (0.5, 30),
+    'getOrderItems': (0.5, 30),
+    # https://github.com/amzn/selling-partner-api-docs/blob/main/references/reports-api/reports_2021-06-30.md
+    'createReport': (0.0167, 15),
+    'getReport': (2.0, 15),
+    'getReportDocument': (0.0167, 15),
+}
+
+
+class TokenBucket:
+    # Token bucket algorithm as used by Amazon to throttle the selling partner requests:
+    # the bucket holds up to `burst` tokens, refills at `rate` tokens per second and every request takes one token
+    # https://github.com/amzn/selling-partner-api-docs/blob/main/guides/en-US/usage-plans-rate-limits/Usage-Plans-and-Rate-Limits.md
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        # Block the calling thread until a token is available, then take it
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def update_rate(self, rate):
+        # Amazon reports the rate actually applied to the selling partner in the x-amzn-RateLimit-Limit header
+        with self.lock:
+            self._refill()
+            self.rate = rate
+
+    def drain(self):
+        # After a 429 the bucket on the Amazon side is empty, so the next request has to wait for a full token
+        with self.lock:
+            self._refill()
+            self.tokens = 0
+
+
+limiters = {}
+limitersLock = threading.Lock()
+
+
+def get_limiter(operation, account='', rate=None, burst=None):
+    # One bucket per operation and selling partner account (Amazon applies the limits per account),
+    # shared by all the threads calling it. Rate and burst are given for the operations without
+    # a default usage plan (the eBay calls)
+    with limitersLock:
+        if (operation, account) not in limiters:
+            if rate is None:
+                rate, burst = AMAZON_RATE_LIMITS[operation]
+            limiters[(operation, account)] = TokenBucket(rate, burst)
+        return limiters[(operation, account)]
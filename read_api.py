@@ -0,0 +1,240 @@
+import base64, collections, datetime, hmac, json, threading, time
+
+from flask import Blueprint, Response, request, stream_with_context
+from sqlalchemy import text
+
+from database import get_data_versions
+from metrics import metrics
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+ORDER_COLUMNS = ('id, order_id, platform, account, creation_date, customer_name, status, subtotal_amount, discount_amount, '
+                 'delivery_amount, tax_amount, total_amount, refund_amount, modification_date, created_at')
+
+
+class ResultCache:
+    # LRU cache of the response bodies with a time to live. The keys include the data versions of the platforms,
+    # so a write batch of the sync makes the cached results of its platform unreachable right away
+    def __init__(self, maxSize, ttl):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None or item[0] < time.monotonic():
+                self.items.pop(key, None)
+                return None
+            self.items.move_to_end(key)
+            return item[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = (time.monotonic() + self.ttl, value)
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxSize:
+                self.items.popitem(last=False)
+
+
+class BadRequest(Exception):
+    pass
+
+
+def encode_cursor(createdAt, rowId):
+    return base64.urlsafe_b64encode(f'{createdAt.isoformat()}|{rowId}'.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        createdAt, rowId = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').split('|')
+        return datetime.datetime.fromisoformat(createdAt), int(rowId)
+    except:
+        raise BadRequest('Invalid cursor')
+
+
+def date_argument(name):
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise BadRequest(f'{name} must be an ISO date')
+
+
+def to_json(value):
+    return json.dumps(value, default=str)
+
+
+def create_read_api(engine, config):
+    # Read-only JSON endpoints over the synced orders, for the scripts which used to query MySQL directly.
+    # The queries use the indexes of the schema (keyset pagination instead of OFFSET), the connections
+    # come from the engine's pool, and the large results are streamed row by row.
+    # The app is reachable from the internet for the OAuth redirect and the webhooks, so every request
+    # needs the "token" of the config in the header Authorization: Bearer <token>
+    apiConfig = config.get('read api', {})
+    if not apiConfig.get('token'):
+        raise Exception('"token" is not set in "read api" in config.json')
+    expectedAuthorization = 'Bearer ' + apiConfig['token']
+    cache = ResultCache(apiConfig.get('cache size', 1000), apiConfig.get('cache seconds', 60))
+    maxCachedBytes = apiConfig.get('max cached bytes', 1000000)
+    versionsSeconds = apiConfig.get('version check seconds', 1)
+    versions = {'checked': 0, 'values': {}}
+    versionsLock = threading.Lock()
+    api = Blueprint('read_api', __name__, url_prefix=apiConfig.get('prefix', '/api'))
+
+    def data_versions():
+        # Read at most every version check seconds, one tiny query for all the platforms
+        with versionsLock:
+            if time.monotonic() - versions['checked'] > versionsSeconds:
+                versions['values'] = get_data_versions(engine)
+                versions['checked'] = time.monotonic()
+            return versions['values']
+
+    def cached(platform, produce):
+        # produce() yields the chunks of the JSON body; the body is cached when it's small enough
+        key = (request.path, tuple(sorted(request.args.items())),
+               data_versions().get(platform) if platform else tuple(sorted(data_versions().items())))
+        body = cache.get(key)
+        if body is not None:
+            metrics.increment('read_api_cache_total', endpoint=request.url_rule.rule, result='hit')
+            return Response(body, mimetype='application/json', headers={'X-Cache': 'HIT'})
+        metrics.increment('read_api_cache_total', endpoint=request.url_rule.rule, result='miss')
+
+        def stream():
+            chunks = []
+            size = 0
+            for chunk in produce():
+                if size <= maxCachedBytes:
+                    chunks.append(chunk)
+                    size += len(chunk)
+                yield chunk
+            if size <= maxCachedBytes:
+                cache.put(key, ''.join(chunks))
+        return Response(stream_with_context(stream()), mimetype='application/json', headers={'X-Cache': 'MISS'})
+
+    @api.before_request
+    def authorize():
+        if not hmac.compare_digest(request.headers.get('Authorization', '').encode('utf-8'),
+                                   expectedAuthorization.encode('utf-8')):
+            return Response(to_json({'error': 'Unauthorized'}), status=401, mimetype='application/json',
+                            headers={'WWW-Authenticate': 'Bearer'})
+
+    @api.errorhandler(BadRequest)
+    def bad_request(error):
+        return Response(to_json({'error': str(error)}), status=400, mimetype='application/json')
+
+    @api.route('/orders')
+    def orders():
+        # Orders by platform, account and creation date, oldest first: ?platform=&account=&since=&until=&limit=&cursor=
+        # Uses the (platform, account, created_at) index, or the created_at index without a platform
+        platform = request.args.get('platform')
+        try:
+            limit = min(int(request.args.get('limit', DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+        except ValueError:
+            raise BadRequest('limit must be a number')
+        if limit < 1:
+            raise BadRequest('limit must be at least 1')
+        conditions = []
+        params = {'limit': limit + 1}
+        if platform:
+            conditions.append('platform=:platform AND account=:account')
+            params.update(platform=platform, account=request.args.get('account', ''))
+        since, until = date_argument('since'), date_argument('until')
+        if since:
+            conditions.append('created_at >= :since')
+            params['since'] = since
+        if until:
+            conditions.append('created_at < :until')
+            params['until'] = until
+        if request.args.get('cursor'):
+            # Keyset pagination: the rows after the last row of the previous page
+            params['afterCreated'], params['afterId'] = decode_cursor(request.args['cursor'])
+            conditions.append('(created_at > :afterCreated OR (created_at = :afterCreated AND id > :afterId))')
+        else:
+            conditions.append('created_at IS NOT NULL')
+        query = text(f"SELECT {ORDER_COLUMNS} FROM orders WHERE {' AND '.join(conditions)} "
+                     f"ORDER BY created_at, id LIMIT :limit;")
+
+        def produce():
+            yield '{"orders": ['
+            lastRow = None
+            with engine.connect() as connection:
+                result = connection.execution_options(stream_results=True).execute(query, params)
+                for i, row in enumerate(result):
+                    if i == limit:
+                        # One row more than the page tells that there is a next page
+                        yield '], "next": ' + to_json(encode_cursor(lastRow['created_at'], lastRow['id'])) + '}'
+                        return
+                    lastRow = row
+                    order = dict(row)
+                    del order['id']
+                    yield (', ' if i else '') + to_json(order)
+            yield '], "next": null}'
+
+        return cached(platform, produce)
+
+    @api.route('/orders/<platform>/<orderId>')
+    def order(platform, orderId):
+        # One order with its line items, by the unique keys of both tables: ?account=
+        account = request.args.get('account', '')
+
+        def produce():
+            with engine.connect() as connection:
+                row = connection.execute(text(
+                    f"SELECT {ORDER_COLUMNS} FROM orders WHERE platform=:platform AND account=:account AND order_id=:orderId;"
+                ), {'platform': platform, 'account': account, 'orderId': orderId}).fetchone()
+                if row is None:
+                    yield to_json({'order': None})
+                    return
+                lineItems = connection.execute(text(
+                    "SELECT line_id, sku, title, quantity, total_amount FROM line_items "
+                    "WHERE account=:account AND order_id=:orderId ORDER BY line_id;"
+                ), {'account': account, 'orderId': orderId}).fetchall()
+            order = dict(row)
+            del order['id']
+            order['line_items'] = [dict(lineItem) for lineItem in lineItems]
+            yield to_json({'order': order})
+
+        return cached(platform, produce)
+
+    @api.route('/sku-sales')
+    def sku_sales():
+        # Daily sales of a SKU from the daily_sku_sales rollup: ?sku=&since=&until=&platform=&account=
+        if not request.args.get('sku'):
+            raise BadRequest('sku is required')
+        platform = request.args.get('platform')
+        conditions = ['sku=:sku']
+        params = {'sku': request.args['sku']}
+        if platform:
+            conditions.append('platform=:platform AND account=:account')
+            params.update(platform=platform, account=request.args.get('account', ''))
+        since, until = date_argument('since'), date_argument('until')
+        if since:
+            conditions.append('sale_date >= :since')
+            params['since'] = since.date()
+        if until:
+            conditions.append('sale_date <= :until')
+            params['until'] = until.date()
+
+        def produce():
+            with engine.connect() as connection:
+                rows = connection.execute(text(
+                    f"""SELECT sale_date, platform, account, orders_count, quantity, total_amount FROM daily_sku_sales
+                    WHERE {' AND '.join(conditions)} ORDER BY sale_date, platform, account;"""
+                ), params).fetchall()
+            days = [dict(row) for row in rows]
+            yield to_json({
+                'sku': params['sku'],
+                'days': days,
+                'orders_count': sum(day['orders_count'] for day in days),
+                'quantity': sum(day['quantity'] for day in days),
+                'total_amount': sum(day['total_amount'] or 0 for day in days),
+            })
+
+        return cached(platform, produce)
+
+    return api
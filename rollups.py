@@ -0,0 +1,69 @@
+import datetime
+
+from sqlalchemy import text, bindparam
+
+# Daily sales per platform account (daily_sales) and per SKU (daily_sku_sales), for the reports that used to
+# group the whole orders and line_items tables. The days touched by a write batch are recalculated from the
+# orders of those days in the same transaction, so updated and changed orders are counted once, with their
+# latest figures. The days are UTC, as the creation dates
+
+DAILY_SALES_SELECT = """SELECT DATE(created_at), platform, account, COUNT(*),
+    SUM(subtotal_amount), SUM(discount_amount), SUM(delivery_amount), SUM(tax_amount), SUM(total_amount),
+    SUM(refund_amount)
+    FROM orders
+    WHERE {where}
+    GROUP BY DATE(created_at), platform, account"""
+
+DAILY_SKU_SALES_SELECT = """SELECT DATE(orders.created_at), orders.platform, orders.account, COALESCE(line_items.sku, ''),
+    COUNT(DISTINCT orders.order_id), SUM(line_items.quantity), SUM(line_items.total_amount)
+    FROM orders
+    JOIN line_items ON line_items.account = orders.account AND line_items.order_id = orders.order_id
+    WHERE {where}
+    GROUP BY DATE(orders.created_at), orders.platform, orders.account, COALESCE(line_items.sku, '')"""
+
+DAILY_SALES_INSERT = """INSERT INTO daily_sales (sale_date, platform, account, orders_count,
+    subtotal_amount, discount_amount, delivery_amount, tax_amount, total_amount, refund_amount)
+    """ + DAILY_SALES_SELECT + ";"
+
+DAILY_SKU_SALES_INSERT = """INSERT INTO daily_sku_sales (sale_date, platform, account, sku,
+    orders_count, quantity, total_amount)
+    """ + DAILY_SKU_SALES_SELECT + ";"
+
+
+def update_rollups(connection, platform, account, days):
+    # Recalculate the given days (YYYY-MM-DD) of one platform account, in the transaction of the write batch.
+    # Every day is its own created_at range, so the (platform, account, created_at) index reads only those days,
+    # also when a batch has a years-old order. A deadlock with another writer on the same day (e.g. all the
+    # platforms writing today's rows) rolls the batch back, and BatchWriter.flush writes it again
+    days = sorted(days)
+    params = {'platform': platform, 'account': account, 'days': days}
+    ranges = []
+    for i, day in enumerate(days):
+        params[f'start{i}'] = day
+        params[f'end{i}'] = (datetime.date.fromisoformat(day) + datetime.timedelta(days=1)).isoformat()
+        ranges.append(f'({{prefix}}created_at >= :start{i} AND {{prefix}}created_at < :end{i})')
+    for table in ('daily_sales', 'daily_sku_sales'):
+        connection.execute(text(
+            f"DELETE FROM {table} WHERE platform=:platform AND account=:account AND sale_date IN :days;"
+        ).bindparams(bindparam('days', expanding=True)), params)
+    for statement, prefix in ((DAILY_SALES_INSERT, ''), (DAILY_SKU_SALES_INSERT, 'orders.')):
+        where = (f"{prefix}platform=:platform AND {prefix}account=:account "
+                 f"AND ({' OR '.join(ranges).format(prefix=prefix)})")
+        connection.execute(text(statement.format(where=where)), params)
+
+
+def rebuild_rollups(engine, since=None, until=None):
+    # Recalculate all the rollups, or the days from since to until (inclusive), e.g. after the orders
+    # were changed in the database directly; returns the number of daily_sales rows of the period
+    params = {
+        'start': since.date().isoformat() if since else '0001-01-01',
+        'end': (until.date() + datetime.timedelta(days=1)).isoformat() if until else '9999-12-31',
+    }
+    with engine.begin() as connection:
+        for table in ('daily_sales', 'daily_sku_sales'):
+            connection.execute(text(f"DELETE FROM {table} WHERE sale_date >= :start AND sale_date < :end;"), params)
+        for statement, prefix in ((DAILY_SALES_INSERT, ''), (DAILY_SKU_SALES_INSERT, 'orders.')):
+            where = f"{prefix}created_at >= :start AND {prefix}created_at < :end"
+            connection.execute(text(statement.format(where=where)), params)
+        return connection.execute(text(
+            "SELECT COUNT(*) FROM daily_sales WHERE sale_date >= :start AND sale_date < :end;"), params).scalar()
@@ -0,0 +1,121 @@
+import datetime, json, random, threading, traceback, logging
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from metrics import metrics, log_event
+
+DEFAULT_POLL_INTERVAL = 120  # seconds
+DEFAULT_JITTER = 0.1  # share of the interval
+
+
+class SyncService:
+    # Resident mode: the engine, the HTTP sessions and the credentials cache are created once,
+    # and each platform account is synced by its own thread every 'poll interval' seconds of its config
+    def __init__(self, config, connectors):
+        self.config = config
+        self.serviceConfig = config.get('service', {})
+        self.connectors = connectors
+        self.stopEvent = threading.Event()
+        self.status = {connector.key: {'last start': None, 'last success': None, 'last error': None,
+                                       'orders saved': 0, 'running': False}
+                       for connector in connectors}
+        self.statusLock = threading.Lock()
+
+    def poll(self, connector):
+        interval = connector.platformConfig.get('poll interval', DEFAULT_POLL_INTERVAL)
+        jitter = self.serviceConfig.get('jitter', DEFAULT_JITTER)
+        while not self.stopEvent.is_set():
+            self.update_status(connector.key, running=True,
+                               **{'last start': datetime.datetime.utcnow().isoformat()})
+            try:
+                ordersSaved = connector.sync(self.stopEvent)
+                print(f'Orders from {connector.name} saved: {ordersSaved}')
+                with self.statusLock:
+                    self.status[connector.key]['orders saved'] += ordersSaved
+                self.update_status(connector.key, **{'last success': datetime.datetime.utcnow().isoformat()})
+            except:
+                logging.error(traceback.format_exc())
+                print(f'\n\nError in {connector.name} execution\n\n')
+                print(traceback.format_exc())
+                self.update_status(connector.key, **{'last error': traceback.format_exc().splitlines()[-1]})
+            self.update_status(connector.key, running=False)
+            self.export_metrics()
+
+            # The jitter keeps the platforms (and several instances) from calling the APIs at the same moments
+            self.stopEvent.wait(interval * (1 + random.uniform(-jitter, jitter)))
+
+    def export_metrics(self):
+        # Same as after a single run: a JSON log line and the Prometheus file
+        log_event('metrics', **metrics.snapshot())
+        if self.config.get('metrics file'):
+            metrics.write_prometheus_file(self.config['metrics file'])
+
+    def update_status(self, key, **values):
+        with self.statusLock:
+            self.status[key].update(values)
+
+    def is_healthy(self):
+        # Healthy if every platform has succeeded within the last three poll intervals
+        now = datetime.datetime.utcnow()
+        with self.statusLock:
+            for connector in self.connectors:
+                lastSuccess = self.status[connector.key]['last success']
+                interval = connector.platformConfig.get('poll interval', DEFAULT_POLL_INTERVAL)
+                if lastSuccess is None:
+                    lastSuccess = self.startedAt
+                if now - datetime.datetime.fromisoformat(lastSuccess) > datetime.timedelta(seconds=3 * interval):
+                    return False
+        return True
+
+    def start_status_server(self):
+        service = self
+
+        class StatusHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body = metrics.to_prometheus().encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                    return
+                if self.path not in ('/', '/status', '/health'):
+                    self.send_error(404)
+                    return
+                healthy = service.is_healthy()
+                with service.statusLock:
+                    body = json.dumps({'healthy': healthy, 'platforms': service.status}).encode('utf-8')
+                self.send_response(200 if healthy else 503)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.statusServer = ThreadingHTTPServer((self.serviceConfig.get('status host', '127.0.0.1'),
+                                                 self.serviceConfig.get('status port', 8787)), StatusHandler)
+        threading.Thread(target=self.statusServer.serve_forever, daemon=True).start()
+
+    def run(self):
+        self.startedAt = datetime.datetime.utcnow().isoformat()
+        self.start_status_server()
+        threads = [threading.Thread(target=self.poll, args=(connector,), name=connector.key)
+                   for connector in self.connectors]
+        for thread in threads:
+            thread.start()
+        print('Sync service started')
+
+        # Wait in short steps, so the signal handlers of the main thread can run
+        while not self.stopEvent.wait(1):
+            pass
+        for thread in threads:
+            thread.join()
+        self.statusServer.shutdown()
+        print('Sync service stopped')
+
+    def stop(self, *args):
+        # Called from SIGTERM/SIGINT: the running syncs stop after the current page
+        print('Stopping the sync service')
+        self.stopEvent.set()
@@ -0,0 +1,144 @@
+import base64, hashlib, hmac, json, logging, os, sqlite3, threading, time, traceback
+
+from credentials import account_config
+from database import find_order_modifications
+from metrics import metrics, log_event
+from normalizers import normalize_wc_order
+from writers import BatchWriter, DEFAULT_BATCH_SIZE
+
+application_path = os.path.abspath(os.path.dirname(__file__))
+
+# WooCommerce webhook topics saved as orders, both carry the whole order as in the REST API
+# WooCommerce docs: https://woocommerce.github.io/woocommerce-rest-api-docs/#webhooks
+WC_ORDER_TOPICS = ('order.created', 'order.updated')
+
+
+def verify_wc_signature(body, signature, secret):
+    # X-WC-Webhook-Signature is the base64 encoded HMAC-SHA256 of the raw request body with the webhook secret
+    expected = base64.b64encode(hmac.new(secret.encode('utf-8'), body, hashlib.sha256).digest()).decode('ascii')
+    return hmac.compare_digest(expected, signature or '')
+
+
+class WebhookQueue:
+    # Durable queue of the received webhook payloads in a SQLite file: a payload is committed to disk before
+    # the webhook is answered, and deleted only after its order is written to MySQL, so nothing is lost
+    # when the app or the database is down
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.added = threading.Event()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS webhooks
+            (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            topic TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );"""
+        )
+        self.connection.commit()
+
+    def put(self, topic, payload):
+        with self.lock:
+            self.connection.execute("INSERT INTO webhooks (topic, payload) VALUES (?, ?);", (topic, payload))
+            self.connection.commit()
+        self.added.set()
+
+    def take(self, limit):
+        # The oldest payloads as (id, topic, payload); they stay in the queue until delete
+        with self.lock:
+            return self.connection.execute("SELECT id, topic, payload FROM webhooks ORDER BY id LIMIT ?;",
+                                           (limit,)).fetchall()
+
+    def delete(self, ids):
+        with self.lock:
+            self.connection.executemany("DELETE FROM webhooks WHERE id=?;", [(i,) for i in ids])
+            self.connection.commit()
+
+    def size(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM webhooks;").fetchone()[0]
+
+
+class WebhookWorker(threading.Thread):
+    # Writes the queued WooCommerce orders to MySQL in micro-batches: a batch is written "webhook batch seconds"
+    # after the first payload arrived, or right away when batch size payloads are already waiting.
+    # The sync state isn't moved, so a polling sync still catches the orders of missed webhooks
+    def __init__(self, config, engine, queue, account=''):
+        super().__init__(daemon=True)
+        self.config = config
+        self.engine = engine
+        self.queue = queue
+        self.account = account
+        self.batchSize = config.get('batch size', DEFAULT_BATCH_SIZE)
+        self.batchSeconds = account_config(config, 'wc', account).get('webhook batch seconds', 2)
+        self.stopEvent = threading.Event()
+        # One writer for all the batches, created with the first one
+        self.writer = None
+
+    def run(self):
+        while not self.stopEvent.is_set():
+            self.queue.added.wait(self.batchSeconds)
+            if self.queue.added.is_set() and self.queue.size() < self.batchSize:
+                # Give the next webhooks of the burst a moment to join the batch
+                self.stopEvent.wait(self.batchSeconds)
+            self.queue.added.clear()
+            try:
+                while self.write_batch() == self.batchSize:
+                    pass
+            except:
+                # The payloads stay in the queue and are retried with the next batch
+                logging.error(traceback.format_exc())
+                print(traceback.format_exc())
+                self.stopEvent.wait(self.batchSeconds)
+
+    def stop(self):
+        self.stopEvent.set()
+        self.queue.added.set()
+
+    def write_batch(self):
+        # Returns the number of payloads taken from the queue
+        items = self.queue.take(self.batchSize)
+        if not items:
+            return 0
+        startTime = time.perf_counter()
+
+        # Webhooks can come more than once and out of order, keep the latest version of every order
+        orders = {}
+        for itemId, topic, payload in items:
+            try:
+                orderRow, lineItemRows = normalize_wc_order(json.loads(payload))
+            except:
+                # A payload that can't be normalized won't get better with retries
+                logging.error(f'WooCommerce webhook {itemId} ({topic}) skipped: {traceback.format_exc()}')
+                continue
+            previous = orders.get(orderRow['order_id'])
+            if previous is None or orderRow['modification_date'] >= previous[0]['modification_date']:
+                orders[orderRow['order_id']] = (orderRow, lineItemRows)
+
+        # Skip the orders already saved with the same or a newer modification
+        savedModifications = find_order_modifications(self.engine, 'wc', list(orders), self.account)
+        if self.writer is None:
+            self.writer = BatchWriter(self.engine, 'wc', self.batchSize, account=self.account)
+        # The rows of a failed batch are still in the queue, they come again with this one
+        self.writer.clear()
+        ordersWritten = self.writer.ordersWritten
+        for orderId, (orderRow, lineItemRows) in orders.items():
+            if (savedModifications.get(orderId) or '') < orderRow['modification_date']:
+                self.writer.add(orderRow, lineItemRows, orderId in savedModifications)
+        self.writer.flush()
+        self.queue.delete([item[0] for item in items])
+
+        metrics.increment('webhooks_processed_total', len(items), platform='wc', account=self.account)
+        log_event('webhooks', platform='wc', account=self.account, received=len(items),
+                  orders=self.writer.ordersWritten - ordersWritten,
+                  seconds=round(time.perf_counter() - startTime, 3))
+        return len(items)
+
+
+def start_webhook_worker(config, engine, account=''):
+    # Returns the queue for the webhook endpoint of the store, the worker runs in a background thread of the app
+    defaultQueue = f'webhooks-{account}.sqlite' if account else 'webhooks.sqlite'
+    queue = WebhookQueue(os.path.join(application_path, account_config(config, 'wc', account).get('webhook queue', defaultQueue)))
+    WebhookWorker(config, engine, queue, account).start()
+    return queue
@@ -0,0 +1,227 @@
+import os, tempfile, threading, time
+
+from sqlalchemy import MetaData, Table, text, bindparam
+from sqlalchemy.dialects.mysql import insert
+from sqlalchemy.exc import OperationalError
+
+from credentials import account_key
+from database import save_sync_state, increase_data_version
+from metrics import metrics
+from rollups import update_rollups
+
+DEFAULT_BATCH_SIZE = 500
+# A batch which hits an InnoDB deadlock (another writer locked the same index gaps) is written again
+DEADLOCK_RETRIES = 3
+
+tables = {}
+tablesLock = threading.Lock()
+
+
+def get_tables(engine):
+    # The orders and line_items tables reflected once per engine, so the writers created by every sync run
+    # and webhook batch don't query the schema again (the migrations run before the first writer)
+    with tablesLock:
+        if engine not in tables:
+            meta = MetaData()
+            tables[engine] = (Table('orders', meta, autoload=True, autoload_with=engine),
+                              Table('line_items', meta, autoload=True, autoload_with=engine))
+        return tables[engine]
+
+
+class BatchWriter:
+    # Collects the normalized orders of one platform and writes them in batches of batchSize orders,
+    # each batch in its own transaction, so a failure loses at most one batch and the memory stays bounded
+    # Above bulkLoadThreshold orders in one run the rest of the rows go to a spool file instead,
+    # loaded with LOAD DATA LOCAL INFILE every bulkLoadThreshold orders (see BulkLoadSpool)
+    # The rows get the account name, and the sync state is saved for the account.
+    # The daily rollups of the days of the written orders and the data version of the platform
+    # (for the caches of the read API) are updated in the same transaction.
+    # The line items of the orders added with replaceLineItems (those already in the database) are replaced
+    def __init__(self, engine, platform, batchSize=DEFAULT_BATCH_SIZE, bulkLoadThreshold=None, account=''):
+        self.engine = engine
+        self.platform = platform
+        self.account = account
+        self.batchSize = batchSize
+        self.bulkLoadThreshold = bulkLoadThreshold
+        self.spool = None
+        self.ordersAdded = 0
+        self.ordersTable, self.lineItemsTable = get_tables(engine)
+        self.orders = []
+        self.lineItems = []
+        self.days = set()
+        self.replacedOrderIds = []
+        self.ordersWritten = 0
+
+    def add(self, orderRow, lineItemRows, replaceLineItems=True):
+        # replaceLineItems: the order may be in the database already, its saved line items are deleted first,
+        # so the lines removed from an edited order go too. The callers which know that the order is new pass
+        # False: deleting keys which don't exist takes gap locks, and those deadlock with the other writers
+        self.ordersAdded += 1
+        if replaceLineItems:
+            self.replacedOrderIds.append(orderRow['order_id'])
+        orderRow['account'] = self.account
+        for lineItemRow in lineItemRows:
+            lineItemRow['account'] = self.account
+        self.days.add(orderRow['creation_date'][:10])
+        if self.spool is None and self.bulkLoadThreshold and self.ordersAdded > self.bulkLoadThreshold:
+            print(f'More than {self.bulkLoadThreshold} orders from {self.platform}, switching to bulk load')
+            self.spool = BulkLoadSpool()
+
+        if self.spool is not None:
+            self.spool.add(orderRow, lineItemRows)
+            if self.spool.ordersCount >= self.bulkLoadThreshold:
+                self.flush()
+            return
+
+        self.orders.append(orderRow)
+        self.lineItems.extend(lineItemRows)
+        if len(self.orders) >= self.batchSize:
+            self.flush()
+
+    def flush(self, syncState=None):
+        spooledRows = self.spool.rowsCount if self.spool is not None else 0
+        rowsCount = len(self.orders) + len(self.lineItems) + spooledRows
+        mode = 'bulk load' if spooledRows else 'upsert'
+        startTime = time.perf_counter()
+        for attempt in range(DEADLOCK_RETRIES + 1):
+            try:
+                with self.engine.begin() as connection:
+                    ordersCount = self.write(connection, syncState)
+                break
+            except OperationalError as error:
+                # MySQL error 1213: the transaction was rolled back, so the whole batch can be written again
+                if error.orig.args[0] != 1213 or attempt == DEADLOCK_RETRIES:
+                    raise
+                print(f'Deadlock writing the {self.platform} orders, writing the batch again')
+                metrics.increment('db_deadlocks_total', platform=self.platform)
+                time.sleep(0.1 * (attempt + 1))
+        if self.spool is not None:
+            self.spool.clear()
+        duration = time.perf_counter() - startTime
+        metrics.observe('db_write_seconds', duration, platform=self.platform, mode=mode)
+        metrics.observe('db_rows_per_batch', rowsCount, platform=self.platform, mode=mode)
+        metrics.observe('phase_seconds', duration, platform=self.platform, phase='write')
+        self.ordersWritten += ordersCount
+        self.clear()
+
+    def clear(self):
+        # Drop the rows not written yet, e.g. those of a failed batch when the writer is reused
+        self.orders = []
+        self.lineItems = []
+        self.days = set()
+        self.replacedOrderIds = []
+
+    def write(self, connection, syncState=None):
+        # Writes the batch in the transaction of the connection, returns the number of orders written
+        ordersCount = len(self.orders)
+        if self.orders:
+            connection.execute(upsert(self.ordersTable, self.orders))
+        if self.replacedOrderIds:
+            connection.execute(text(
+                "DELETE FROM line_items WHERE account=:account AND order_id IN :orderIds;"
+            ).bindparams(bindparam('orderIds', expanding=True)),
+                {'account': self.account, 'orderIds': self.replacedOrderIds})
+        if self.lineItems:
+            connection.execute(upsert(self.lineItemsTable, self.lineItems))
+        if self.spool is not None:
+            ordersCount += self.spool.load(connection, self.ordersTable, self.lineItemsTable)
+        if self.days:
+            update_rollups(connection, self.platform, self.account, self.days)
+            increase_data_version(connection, self.platform)
+        # The watermark is saved with the last batch: if the run fails before that,
+        # the next run asks for the same orders again and skips those already written
+        if syncState is not None:
+            save_sync_state(connection, account_key(self.platform, self.account), syncState)
+        return ordersCount
+
+    def finish(self, syncState=None):
+        try:
+            self.flush(syncState)
+        finally:
+            self.close()
+        return self.ordersWritten
+
+    def close(self):
+        # Removes the spool files, also those of a run which failed before finish
+        if self.spool is not None:
+            self.spool.close()
+
+
+def upsert(table, rows):
+    # One multi-row INSERT ... ON DUPLICATE KEY UPDATE: the rows already in the table (same unique key) are
+    # overwritten with the new values, so the repeated and overlapping syncs don't create duplicates
+    statement = insert(table).values(rows)
+    return statement.on_duplicate_key_update({column: statement.inserted[column] for column in rows[0]})
+
+
+class BulkLoadSpool:
+    # Rows are written to tab-separated files in the format expected by LOAD DATA, loaded into temporary
+    # staging tables and merged into orders/line_items with one INSERT ... SELECT ... ON DUPLICATE KEY UPDATE.
+    # The files are kept until the transaction is committed, so a batch rolled back by a deadlock can be loaded again.
+    # Needs local_infile enabled on the MySQL server (the engine enables it on the client side)
+    # MySQL docs: https://dev.mysql.com/doc/refman/8.0/en/load-data.html
+    def __init__(self):
+        self.files = {}
+        self.columns = {}
+        self.ordersCount = 0
+        self.rowsCount = 0
+
+    def add(self, orderRow, lineItemRows):
+        self.write_row('orders', orderRow)
+        for lineItemRow in lineItemRows:
+            self.write_row('line_items', lineItemRow)
+        self.ordersCount += 1
+
+    def write_row(self, tableName, row):
+        if tableName not in self.files:
+            self.files[tableName] = tempfile.NamedTemporaryFile('w', encoding='utf-8', newline='\n',
+                                                               suffix='.tsv', delete=False)
+            self.columns[tableName] = list(row)
+        self.files[tableName].write('\t'.join(tsv_value(row.get(column)) for column in self.columns[tableName]) + '\n')
+        self.rowsCount += 1
+
+    def load(self, connection, ordersTable, lineItemsTable):
+        # The line items of the replaced orders are deleted by BatchWriter.write before the load
+        ordersCount = self.ordersCount
+        for table in (ordersTable, lineItemsTable):
+            if table.name not in self.files:
+                continue
+            spoolFile = self.files[table.name]
+            spoolFile.close()
+            columns = ', '.join(self.columns[table.name])
+            updates = ', '.join(f'{column}=VALUES({column})' for column in self.columns[table.name])
+            connection.execute(text(f"CREATE TEMPORARY TABLE {table.name}_staging LIKE {table.name};"))
+            try:
+                # REPLACE keeps the last version of a row repeated in the spool
+                connection.execute(text(
+                    f"""LOAD DATA LOCAL INFILE :path REPLACE INTO TABLE {table.name}_staging
+                    CHARACTER SET utf8mb4 FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' LINES TERMINATED BY '\\n'
+                    ({columns});"""
+                ), {'path': spoolFile.name})
+                connection.execute(text(
+                    f"""INSERT INTO {table.name} ({columns})
+                    SELECT {columns} FROM {table.name}_staging
+                    ON DUPLICATE KEY UPDATE {updates};"""
+                ))
+            finally:
+                connection.execute(text(f"DROP TEMPORARY TABLE IF EXISTS {table.name}_staging;"))
+        return ordersCount
+
+    def clear(self):
+        # After the loaded rows are committed: the next rows go to new files
+        self.close()
+        self.ordersCount = 0
+        self.rowsCount = 0
+
+    def close(self):
+        for spoolFile in self.files.values():
+            spoolFile.close()
+            os.remove(spoolFile.name)
+        self.files = {}
+
+
+def tsv_value(value):
+    # Escaping of the LOAD DATA default format: NULL is \N, backslash, tab and new line are escaped with a backslash
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')